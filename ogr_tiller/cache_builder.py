@@ -1,63 +1,213 @@
+import json
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, List, Tuple
+import morecantile
 from ogr_tiller.poco.job_param import JobParam
 from ogr_tiller.poco.tileset_manifest import TilesetManifest
+from ogr_tiller.utils.arrow_utils import setup_ogr_reader
 from ogr_tiller.utils.job_utils import common
 from ogr_tiller.utils.monitor import timeit
-from ogr_tiller.utils.ogr_utils import get_data_location, get_tile_json, get_tileset_manifest, get_tilesets
-from ogr_tiller.utils.sqlite_utils import cleanup_mbtile_cache, update_multiple_cache
+from ogr_tiller.utils.ogr_utils import get_data_location, get_tileset_manifest, get_tilesets, setup_ogr_cache
+from ogr_tiller.utils.prepare_utils import get_prepared_path, get_source_path
+from ogr_tiller.utils.tileset_registry import get_tileset_info
+from ogr_tiller.utils.cache_backend import get_cache_backend, open_tile_writer
+from ogr_tiller.utils.directory_utils import cleanup_orphan_tile_folders
+from ogr_tiller.utils.sqlite_utils import cleanup_mbtile_cache, cleanup_orphan_mbtile_cache, get_built_subtrees, prune_images, read_metadata, remove_mbtile_cache, update_metadata
 import ogr_tiller.utils.tile_utils as tile_utils
 from rich import print
 from rich.progress import Progress, TextColumn, SpinnerColumn, BarColumn, MofNCompleteColumn, TimeElapsedColumn, TimeRemainingColumn
 
+tms = morecantile.tms.get("WebMercatorQuad")
+# features of the last tileset loaded by this (worker) process, per layer and filter.
+# zoom bands with the same filter for a layer share its features.
+loaded_tileset = None
+loaded_source = None
+loaded_layers = {}
+
+
+def init_build_worker(job_param: JobParam):
+    setup_ogr_cache(job_param.data_folder)
+    setup_ogr_reader(job_param.ogr_reader)
+
+
+def load_tileset_features(tileset: str, cache_folder: str, manifest: TilesetManifest, zoom: int):
+    # the filters of the zoom are pushed into the read, so filtered out rows are never decoded
+    global loaded_tileset, loaded_source, loaded_layers
+    if loaded_tileset != tileset:
+        ds_path = get_source_path(
+            os.path.join(get_data_location(), f'{tileset}.gpkg'),
+            get_prepared_path(cache_folder, tileset), manifest)
+        loaded_tileset = tileset
+        loaded_source = ds_path, tile_utils.list_dataset_layers(ds_path)
+        loaded_layers = {}
+    ds_path, layer_names = loaded_source
+    layer_features = []
+    srid = None
+    for layer_name in layer_names:
+        properties, where = tile_utils.get_read_options(manifest, layer_name, zoom)
+        if (layer_name, where) not in loaded_layers:
+            layer_srid, layers = tile_utils.get_layer_features(ds_path, layer_name, layer_names, properties, where)
+            loaded_layers[(layer_name, where)] = layer_srid, tile_utils.index_layer_features(layers)
+        srid, indexed_layers = loaded_layers[(layer_name, where)]
+        layer_features.extend(indexed_layers)
+    return layer_features, srid
+
+
+def build_subtree(job_param: JobParam, tileset: str, x: int, y: int, z: int, min_zoom: int, max_zoom: int) -> int:
+    # runs in the worker processes, streams tiles into the cache and returns the tile count
+    manifest: TilesetManifest = get_tileset_manifest()[tileset]
+    with open_tile_writer(job_param, tileset) as writer:
+        # every band descends from the subtree root but only writes the tiles of its zooms
+        for band_min_zoom, band_max_zoom in manifest.get_zoom_bands(max(min_zoom, z), max_zoom):
+            layer_features, srid = load_tileset_features(tileset, job_param.cache_folder, manifest, band_min_zoom)
+            tile_utils.get_tile_descendant_tiles(tileset, layer_features, x, y, z, manifest, srid, band_min_zoom, band_max_zoom, writer, None, None)
+        if writer.errors > 0:
+            # without a checkpoint resume and incremental builds generate the subtree again
+            writer.flush()
+            print(f'{tileset}: {writer.errors} tiles of subtree {x} {y} {z} failed, the subtree is not marked as built')
+        else:
+            writer.checkpoint(x, y, z, max_zoom)
+    return writer.count
+
+
+def get_subtrees(tilejson: Any, manifest: TilesetManifest, split_zoom: int) -> List[Tuple[int, int, int, int]]:
+    # (x, y, z, max_zoom) roots, tiles above the split zoom are walked from 0/0/0
+    min_zoom = tilejson["minzoom"]
+    max_zoom = tilejson["maxzoom"]
+    split_zoom = max(0, min(split_zoom, max_zoom))
+    subtrees = []
+    if split_zoom > 0 and split_zoom - 1 >= min_zoom:
+        subtrees.append((0, 0, 0, split_zoom - 1))
+
+    # pad the data bounds by the tile buffer so edge tiles are not missed
+    minx, miny, maxx, maxy = tilejson['bounds']
+    left, bottom = tms.xy(minx, miny, truncate=True)
+    right, top = tms.xy(maxx, maxy, truncate=True)
+    tile_bounds = tms.xy_bounds(morecantile.Tile(0, 0, split_zoom))
+    pad = (tile_bounds.right - tile_bounds.left) * manifest.tile_buffer / manifest.extent
+    west, south = tms.lnglat(left - pad, bottom - pad, truncate=True)
+    east, north = tms.lnglat(right + pad, top + pad, truncate=True)
+    for tile in tms.tiles(west, south, east, north, zooms=[split_zoom], truncate=True):
+        subtrees.append((tile.x, tile.y, tile.z, max_zoom))
+    return subtrees
+
+
+def source_fingerprint(tileset: str, manifest: TilesetManifest) -> str:
+    # changes when the geopackage or its manifest entry changes
+    ds_path = os.path.join(get_data_location(), f'{tileset}.gpkg')
+    stat = os.stat(ds_path)
+    return json.dumps({
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'manifest': manifest.__repr__()
+    })
+
+
 @timeit
 def build_cache(job_param: JobParam):
-    # cleanup existing mbtile cache
-    cleanup_mbtile_cache(job_param.cache_folder)
-    # setup mbtile cache 
+    # full rebuilds start from an empty cache, resume and incremental keep finished subtrees
+    if job_param.build_mode == 'full':
+        cleanup_mbtile_cache(job_param.cache_folder)
+    # setup mbtile cache
     common(job_param)
 
     tilesets = get_tilesets()
+    if job_param.build_mode == 'incremental':
+        cleanup_orphan_mbtile_cache(job_param.cache_folder, tilesets)
+        cleanup_orphan_tile_folders(job_param.cache_folder, tilesets)
+
+    executor = None
+    if job_param.workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=job_param.workers, initializer=init_build_worker, initargs=(job_param,))
+
+    def submit(tileset: str, x: int, y: int, z: int, min_zoom: int, max_zoom: int):
+        if executor is None:
+            return build_subtree(job_param, tileset, x, y, z, min_zoom, max_zoom)
+        return executor.submit(build_subtree, job_param, tileset, x, y, z, min_zoom, max_zoom)
 
     def process_tileset(tileset: str):
         print(f'{tileset}: working on tileset')
         manifest: TilesetManifest = get_tileset_manifest()[tileset]
-        tilejson = get_tile_json(tileset, job_param.port, manifest)
+        tilejson = get_tileset_info(tileset).tilejson
         if tilejson['bounds'] is None:
             print(f'{tileset}: skipping tileset because it may be empty')
             progress.update(progress_tilesets_task_id, advance=1)
             return
 
-        # prep
-        
-        #print('working on seed ', tileset, seed_x, seed_y, seed_z)
-        progress_task_id = progress.add_task(description=f"{tileset}", total=None)
-        ds_path = os.path.join(get_data_location(), f'{tileset}.gpkg')
-        manifest: TilesetManifest = get_tileset_manifest()[tileset]
-        layer_features, srid = tile_utils.get_all_features(ds_path)
-        
+        fingerprint = source_fingerprint(tileset, manifest)
+        if job_param.build_mode == 'incremental' and read_metadata(tileset, 'source_fingerprint') != fingerprint:
+            print(f'{tileset}: source changed since the last build, rebuilding tileset')
+            remove_mbtile_cache(tileset)
+            get_cache_backend().setup(tileset, job_param.cache_folder, tilejson)
+        if job_param.build_mode != 'resume':
+            update_metadata(tileset, 'source_fingerprint', fingerprint)
+
+        subtrees = get_subtrees(tilejson, manifest, job_param.split_zoom)
+        built_subtrees = set()
+        if job_param.build_mode != 'full':
+            built_subtrees = get_built_subtrees(tileset)
+        pending_subtrees = [subtree for subtree in subtrees if subtree not in built_subtrees]
+        if len(pending_subtrees) < len(subtrees):
+            print(f'{tileset}: skipping {len(subtrees) - len(pending_subtrees)} of {len(subtrees)} subtrees built earlier')
+
+        progress_task_id = progress.add_task(description=f"{tileset}", total=len(subtrees), completed=len(subtrees) - len(pending_subtrees), tiles=0)
+        tile_count = 0
+
+        def completed(subtree_tile_count: int):
+            nonlocal tile_count
+            tile_count += subtree_tile_count
+            progress.update(progress_task_id, advance=1, tiles=tile_count)
+
+        jobs = {}
+        for x, y, z, max_zoom in pending_subtrees:
+            if executor is None:
+                # a failed subtree is reported and skipped, like in the worker processes
+                try:
+                    completed(submit(tileset, x, y, z, tilejson["minzoom"], max_zoom))
+                except Exception as e:
+                    print('error processing subtree', tileset, x, y, z)
+                    print(e)
+                    traceback.print_exc()
+            else:
+                jobs[submit(tileset, x, y, z, tilejson["minzoom"], max_zoom)] = (x, y, z)
+
+        for job in as_completed(jobs):
+            try:
+                completed(job.result())
+            except Exception as e:
+                print('error processing subtree', tileset, *jobs[job])
+                print(e)
+                traceback.print_exc()
 
+        # resumed builds can replace tiles whose images nothing refers to anymore
+        if job_param.build_mode != 'full':
+            prune_images(tileset)
+        get_cache_backend().finish_build(tileset)
 
-        result = []
-        
-        tile_utils.get_tile_descendant_tiles(tileset, layer_features, 0, 0, 0, manifest, srid, tilejson["minzoom"], tilejson["maxzoom"], result, progress, progress_task_id)
-        progress.update(progress_task_id, total=len(result))
         progress.update(progress_tilesets_task_id, advance=1)
-        
-        print(f'{tileset}: number of tiles generated for {tileset} {len(result)}')
-        print(f'{tileset}: writing the mbtile files')
-        update_multiple_cache(tileset, result)
+        print(f'{tileset}: number of tiles generated for {tileset} {tile_count}')
         print(f'{tileset}: completed generating tileset: {tileset}')
 
-    with Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            TextColumn("•"),
-            TimeElapsedColumn(),
-        ) as progress:
-        progress_tilesets_task_id = progress.add_task(description=f"All Tilesets", total=len(tilesets))
-        for tileset in tilesets:
-            process_tileset(tileset)
-        
+    try:
+        with Progress(
+                SpinnerColumn(),
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                MofNCompleteColumn(),
+                TextColumn("•"),
+                TextColumn("{task.fields[tiles]} tiles"),
+                TextColumn("•"),
+                TimeElapsedColumn(),
+            ) as progress:
+            progress_tilesets_task_id = progress.add_task(description=f"All Tilesets", total=len(tilesets), tiles='-')
+            for tileset in tilesets:
+                process_tileset(tileset)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
+    # checkpoint the wal so the mbtiles files are self contained
+    get_cache_backend().close()
@@ -14,17 +14,32 @@ def get_arg(param):
 
 def cli():
     parser = argparse.ArgumentParser(prog='ogr_tiller')
-    parser.add_argument('--mode', help='mode', default='serve') # serve, build_cache, serve_cache
+    parser.add_argument('--mode', help='mode', default='serve') # serve, build_cache, serve_cache, prepare
     parser.add_argument('--data_folder', help='data folder', required=True)
     parser.add_argument('--cache_folder', help='cache folder', required=True)
     parser.add_argument('--stylesheet_folder', help='stylesheet folder', default=None)
     parser.add_argument('--disable_caching', help='disable caching', default='false')
     parser.add_argument('--port', help='port', default='8080')
     parser.add_argument('--tile_timeout', help='timeout for dynamic tile generation', default='3')
+    parser.add_argument('--tile_workers', help='number of workers generating dynamic tiles', default='4')
+    parser.add_argument('--tile_queue_size', help='tiles allowed to wait for a worker before returning 503', default='64')
+    parser.add_argument('--tile_executor', help='worker type for dynamic tiles', default='thread') # thread, process
+    parser.add_argument('--workers', help='number of processes building the cache', default='1')
+    parser.add_argument('--split_zoom', help='zoom at which the cache build is split into subtrees', default='6')
+    parser.add_argument('--batch_tiles', help='tiles written per cache build commit', default='500')
+    parser.add_argument('--batch_mb', help='megabytes of tiles written per cache build commit', default='32')
+    parser.add_argument('--build_mode', help='build_cache mode', default='full') # full, resume, incremental
+    parser.add_argument('--memory_cache_mb', help='size of the in memory tile cache in megabytes, 0 disables it', default='64')
+    parser.add_argument('--prepare_sources', help='write web mercator copies of the datasets on start', default='false')
+    parser.add_argument('--cache_format', help='format of the tile cache', default='mbtiles') # mbtiles, pmtiles, directory
+    parser.add_argument('--ogr_reader', help='reader of the geopackage features', default='fiona') # fiona, arrow
 
     args = parser.parse_args()
     disable_caching = args.disable_caching.lower().capitalize() == 'True'
+    prepare_sources = args.prepare_sources.lower().capitalize() == 'True'
     tile_timeout = int(args.tile_timeout)
+    tile_workers = int(args.tile_workers)
+    tile_queue_size = int(args.tile_queue_size)
     param = JobParam(
         args.mode, 
         args.data_folder, 
@@ -32,5 +47,17 @@ def cli():
         args.stylesheet_folder,
         args.port, 
         disable_caching, 
-        tile_timeout)
+        tile_timeout,
+        tile_workers,
+        tile_queue_size,
+        args.tile_executor,
+        int(args.workers),
+        int(args.split_zoom),
+        int(args.batch_tiles),
+        int(args.batch_mb),
+        args.build_mode,
+        int(args.memory_cache_mb),
+        prepare_sources,
+        args.cache_format,
+        args.ogr_reader)
     start_tiller_process(param)
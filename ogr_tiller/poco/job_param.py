@@ -6,7 +6,19 @@ class JobParam:
                  stylesheet_folder: str,
                  port: str,
                  disable_caching: bool,
-                 tile_timeout: int):
+                 tile_timeout: int,
+                 tile_workers: int = 4,
+                 tile_queue_size: int = 64,
+                 tile_executor: str = 'thread',
+                 workers: int = 1,
+                 split_zoom: int = 6,
+                 batch_tiles: int = 500,
+                 batch_mb: int = 32,
+                 build_mode: str = 'full',
+                 memory_cache_mb: int = 64,
+                 prepare_sources: bool = False,
+                 cache_format: str = 'mbtiles',
+                 ogr_reader: str = 'fiona'):
         self.mode = mode
         self.data_folder = data_folder
         self.cache_folder = cache_folder
@@ -14,3 +26,15 @@ class JobParam:
         self.port = port
         self.disable_caching = disable_caching
         self.tile_timeout = tile_timeout
+        self.tile_workers = tile_workers
+        self.tile_queue_size = tile_queue_size
+        self.tile_executor = tile_executor
+        self.workers = workers
+        self.split_zoom = split_zoom
+        self.batch_tiles = batch_tiles
+        self.batch_mb = batch_mb
+        self.build_mode = build_mode
+        self.memory_cache_mb = memory_cache_mb
+        self.prepare_sources = prepare_sources
+        self.cache_format = cache_format
+        self.ogr_reader = ogr_reader
@@ -0,0 +1,38 @@
+from typing import Any, Dict
+import numpy as np
+
+
+class LayerFeatures:
+    def __init__(self,
+                 name: str,
+                 geometries: np.ndarray,
+                 properties: Dict[str, np.ndarray]):
+        # geometries is an array of shapely geometries, properties holds one array per field
+        self.name = name
+        self.geometries = geometries
+        self.properties = properties
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def take(self, indices: Any) -> 'LayerFeatures':
+        # indices can be an index array or a boolean mask
+        return LayerFeatures(
+            self.name,
+            self.geometries[indices],
+            {field: values[indices] for field, values in self.properties.items()})
+
+    def iter_features(self):
+        fields = list(self.properties.keys())
+        columns = [self.properties[field] for field in fields]
+        for i, geometry in enumerate(self.geometries):
+            yield {
+                "geometry": geometry,
+                "properties": {field: column[i] for field, column in zip(fields, columns)}
+            }
+
+    def __str__(self):
+        return f'name: {self.name} features: {len(self)} fields: {list(self.properties.keys())}'
+
+    def __repr__(self):
+        return {'name': self.name, 'features': len(self), 'fields': list(self.properties.keys())}.__repr__()
@@ -0,0 +1,34 @@
+from typing import List, Optional, Tuple
+
+
+class LayerManifest:
+    def __init__(self,
+                 name: str,
+                 max_features: int = None,
+                 max_bytes: int = None,
+                 strategy: str = None,
+                 properties: List[str] = None,
+                 filters: List[Tuple[int, int, str]] = None):
+        self.name = name
+        # budgets of the layer in one tile, None is unlimited
+        self.max_features = max_features
+        self.max_bytes = max_bytes
+        # drop_densest, cluster or drop_smallest, None picks one by geometry type
+        self.strategy = strategy
+        # fields read and written to tiles, None is every field
+        self.properties = properties
+        # (minzoom, maxzoom, where) attribute filters passed to the OGR read
+        self.filters = filters if filters is not None else []
+
+    def get_where(self, zoom: int) -> Optional[str]:
+        # filters of every band containing the zoom apply together
+        wheres = [f'({where})' for minzoom, maxzoom, where in self.filters if minzoom <= zoom <= maxzoom]
+        if len(wheres) == 0:
+            return None
+        return ' AND '.join(wheres)
+
+    def __str__(self):
+        return f'name: {self.name} max_features: {self.max_features} max_bytes: {self.max_bytes} strategy: {self.strategy} properties: {self.properties} filters: {self.filters}'
+
+    def __repr__(self):
+        return {'name': self.name, 'max_features': self.max_features, 'max_bytes': self.max_bytes, 'strategy': self.strategy, 'properties': self.properties, 'filters': self.filters}.__repr__()
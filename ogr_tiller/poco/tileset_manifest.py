@@ -1,3 +1,7 @@
+from typing import Dict, List, Tuple
+from ogr_tiller.poco.layer_manifest import LayerManifest
+
+
 class TilesetManifest:
     def __init__(self,
                  name: str,
@@ -6,7 +10,14 @@ class TilesetManifest:
                  attribution: str,
                  extent: int,
                  tile_buffer: int,
-                 simplify_tolerance: float):
+                 simplify_tolerance: float,
+                 overzoom: bool = True,
+                 max_age: Dict[str, int] = None,
+                 lod: bool = False,
+                 max_features: int = None,
+                 max_bytes: int = None,
+                 layers: Dict[str, LayerManifest] = None,
+                 polylabel: bool = False):
         self.name = name
         self.minzoom = minzoom
         self.maxzoom = maxzoom
@@ -14,10 +25,46 @@ class TilesetManifest:
         self.extent = extent
         self.tile_buffer = tile_buffer
         self.simplify_tolerance = simplify_tolerance
+        # tiles above maxzoom are cut from the maxzoom tile
+        self.overzoom = overzoom
+        # Cache-Control max-age in seconds of tiles and tilejson per serving mode
+        self.max_age = max_age if max_age is not None else {'serve': 0, 'serve_cache': 0}
+        # dynamic tiles read pre-simplified copies written by the prepare step
+        self.lod = lod
+        # budgets of one tile over all layers, None is unlimited
+        self.max_features = max_features
+        self.max_bytes = max_bytes
+        self.layers = layers if layers is not None else {}
+        # label points of prepared datasets are placed with polylabel instead of point_on_surface
+        self.polylabel = polylabel
+
+    def get_layer_manifest(self, layer_name: str) -> LayerManifest:
+        # label layers share the budgets of their polygon layer
+        layer_manifest = self.layers.get(layer_name)
+        if layer_manifest is None and layer_name.endswith('_label'):
+            layer_manifest = self.layers.get(layer_name[:-len('_label')])
+        return layer_manifest if layer_manifest is not None else LayerManifest(layer_name)
+
+    def get_zoom_bands(self, min_zoom: int, max_zoom: int) -> List[Tuple[int, int]]:
+        # (min_zoom, max_zoom) ranges in which the filters of every layer stay the same
+        breaks = {min_zoom, max_zoom + 1}
+        for layer_manifest in self.layers.values():
+            for minzoom, maxzoom, where in layer_manifest.filters:
+                breaks.update([minzoom, maxzoom + 1])
+        breaks = sorted(zoom for zoom in breaks if min_zoom <= zoom <= max_zoom + 1)
+        return [(start, end - 1) for start, end in zip(breaks[:-1], breaks[1:])]
+
+    def has_budgets(self) -> bool:
+        if self.max_features is not None or self.max_bytes is not None:
+            return True
+        return any(layer.max_features is not None or layer.max_bytes is not None for layer in self.layers.values())
+
+    def get_max_age(self, mode: str) -> int:
+        return self.max_age.get(mode, 0)
 
     def __str__(self):
-        return f'name: {self.name} minzoom: {self.minzoom} maxzoom: {self.maxzoom} attribution: {self.attribution} extent: {self.extent} tile_buffer: {self.tile_buffer} simplify_tolerance: {self.simplify_tolerance}'
+        return f'name: {self.name} minzoom: {self.minzoom} maxzoom: {self.maxzoom} attribution: {self.attribution} extent: {self.extent} tile_buffer: {self.tile_buffer} simplify_tolerance: {self.simplify_tolerance} overzoom: {self.overzoom} max_age: {self.max_age} lod: {self.lod} max_features: {self.max_features} max_bytes: {self.max_bytes} layers: {list(self.layers.values())} polylabel: {self.polylabel}'
 
     def __repr__(self):
-        return {'name': self.name, 'minzoom': self.minzoom, 'maxzoom': self.maxzoom, 'attribution': self.attribution, 'extent': self.extent, 'tile_buffer': self.tile_buffer, 'simplify_tolerance': self.simplify_tolerance}.__repr__()
+        return {'name': self.name, 'minzoom': self.minzoom, 'maxzoom': self.maxzoom, 'attribution': self.attribution, 'extent': self.extent, 'tile_buffer': self.tile_buffer, 'simplify_tolerance': self.simplify_tolerance, 'overzoom': self.overzoom, 'max_age': self.max_age, 'lod': self.lod, 'max_features': self.max_features, 'max_bytes': self.max_bytes, 'layers': list(self.layers.values()), 'polylabel': self.polylabel}.__repr__()
 
@@ -1,21 +1,25 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from ogr_tiller.cache_builder import build_cache
 from ogr_tiller.poco.tileset_manifest import TilesetManifest
-from ogr_tiller.utils.job_utils import common
-from ogr_tiller.utils.ogr_utils import get_stylesheets, get_tile_json, get_tileset_manifest, get_tilesets
+from ogr_tiller.utils.job_utils import common, setup_tile_worker
+from ogr_tiller.utils.ogr_utils import get_stylesheets, get_tileset_manifest, get_tilesets, setup_ogr_cache
+from ogr_tiller.utils.prepare_utils import prepare_sources
 from ogr_tiller.poco.job_param import JobParam
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import Response
-from ogr_tiller.utils.fast_api_utils import TimeOutException, timeout_response
+from ogr_tiller.utils.fast_api_utils import AcceptEncodingGZipMiddleware, TimeOutException, accepts_gzip, cache_control_header, content_etag, etag_matches, overloaded_response, timeout_response
+from ogr_tiller.utils.memory_cache import get_memory_cache
+from ogr_tiller.utils.single_flight import SingleFlight
 
-from ogr_tiller.utils.sqlite_utils import read_cache, update_cache
-from ogr_tiller.utils.stylesheet_utils import get_starter_style
+from ogr_tiller.utils.cache_backend import get_cache_backend
 import ogr_tiller.utils.tile_utils as tile_utils
+import ogr_tiller.utils.tileset_registry as tileset_registry
+from ogr_tiller.utils.worker_pool import PoolSaturatedException, TileWorkerPool
 import json
 from fastapi.responses import FileResponse
 
-from fastapi.middleware.gzip import GZipMiddleware
 from rich import print
 import os
 
@@ -24,8 +28,20 @@ def start_api(job_param: JobParam):
     # setup mbtile cache
     common(job_param)
 
+    # dynamic tiles are generated off the event loop
+    tile_pool = TileWorkerPool(
+        job_param.tile_executor,
+        job_param.tile_workers,
+        job_param.tile_queue_size,
+        job_param.tile_timeout,
+        initializer=setup_tile_worker,
+        initargs=(job_param,))
+    # concurrent misses on the same tile wait for a single generation
+    tile_flights = SingleFlight()
+
     app = FastAPI()
-    app.add_middleware(GZipMiddleware)
+    # responses that already carry a Content-Encoding, like stored tiles, are passed through
+    app.add_middleware(AcceptEncodingGZipMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -51,65 +67,167 @@ def start_api(job_param: JobParam):
         }
         return FileResponse(os.path.join(job_param.stylesheet_folder, f'{stylesheet}.json'), headers=headers)
 
-    @app.get("/styles/system/starter.json")
-    async def get_style_json():
-        tilesets = get_tilesets()
-        stylesheet = get_starter_style(
-            job_param.port, tilesets, job_param.data_folder)
+    def json_response(request: Request, content: bytes, etag: str, cache_control: str = 'no-cache'):
         headers = {
             "content-type": "application/json",
-            "Cache-Control": 'no-cache, no-store'
+            "Cache-Control": cache_control,
+            "ETag": etag
         }
-        return Response(content=json.dumps(stylesheet), headers=headers)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=content, headers=headers)
+
+    @app.get("/styles/system/starter.json")
+    async def get_style_json(request: Request):
+        starter_style = await run_in_threadpool(tileset_registry.get_starter_style_info, get_tilesets())
+        return json_response(request, starter_style.content, starter_style.etag)
 
     @app.get("/tilesets/{tileset}/info/tile.json")
-    async def get_tileset_info(tileset: str):
-        headers = {
-            "content-type": "application/json",
-            "Cache-Control": 'no-cache, no-store'
-        }
+    async def get_tileset_info(tileset: str, request: Request):
         if tileset not in get_tilesets():
+            headers = {
+                "content-type": "application/json",
+                "Cache-Control": 'no-cache, no-store'
+            }
             return Response(status_code=404, headers=headers)
 
-        tilejson = get_tile_json(tileset, job_param.port,
-                             get_tileset_manifest()[tileset])
+        manifest: TilesetManifest = get_tileset_manifest()[tileset]
+        info = await run_in_threadpool(tileset_registry.get_tileset_info, tileset)
+        cache_control = cache_control_header(manifest.get_max_age(job_param.mode))
+        return json_response(request, info.tilejson_bytes, info.etag, cache_control)
+
+    def tile_response(request: Request, tile_data: bytes, etag: str, headers):
+        # stored tiles are gzip compressed, only clients without gzip support get them decompressed
+        decompress = False
+        if tile_utils.is_compressed_tile(tile_data):
+            headers['Vary'] = 'Accept-Encoding'
+            if accepts_gzip(request.headers.get('accept-encoding')):
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                decompress = True
+                # the decompressed bytes are a different representation and need their own etag
+                etag = f'{etag[:-1]}-identity"'
+        headers['ETag'] = etag
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            headers.pop('Content-Encoding', None)
+            return Response(status_code=304, headers=headers)
+        if decompress:
+            tile_data = tile_utils.decompress_tile(tile_data)
+        return Response(content=tile_data, headers=headers)
+
+    async def load_tile(tileset: str, manifest: TilesetManifest, z: int, x: int, y: int):
+        # (tile_data, etag) or None
+        memory_cache = get_memory_cache()
+        memory_cache_key = (tileset, z, x, y)
+        if memory_cache is not None:
+            cached_tile = memory_cache.get(memory_cache_key)
+            if cached_tile is not None:
+                return cached_tile
+
+        if job_param.mode == 'serve_cache' or not job_param.disable_caching:
+            cached_tile = await run_in_threadpool(get_cache_backend().read_tile, tileset, x, y, z)
+            if cached_tile is not None:
+                # the tile id stored with the tile is the hash of its data
+                cached_data, tile_id = cached_tile
+                etag = f'"{tile_id}"'
+                if memory_cache is not None:
+                    memory_cache.put(memory_cache_key, cached_data, etag)
+                return cached_data, etag
+
+        # tile not found return 404 directly
+        if job_param.mode == 'serve_cache':
+            return None
+
+        async def generate_tile():
+            tile_data = await tile_pool.run(tile_utils.get_tile, tileset, x, y, z, manifest.extent)
+            if tile_data is None:
+                return None
+            etag = content_etag(tile_data)
 
-        return Response(content=json.dumps(tilejson), headers=headers)
+            # update cache
+            if memory_cache is not None:
+                memory_cache.put(memory_cache_key, tile_data, etag)
+            if not job_param.disable_caching:
+                await run_in_threadpool(get_cache_backend().write_tile, tileset, x, y, z, tile_data)
+            return tile_data, etag
+
+        return await tile_flights.run(memory_cache_key, generate_tile)
+
+    async def load_overzoomed_tile(tileset: str, manifest: TilesetManifest, z: int, x: int, y: int):
+        # only kept in memory, the mbtiles cache holds the tiles up to maxzoom
+        memory_cache = get_memory_cache()
+        memory_cache_key = (tileset, z, x, y)
+        if memory_cache is not None:
+            cached_tile = memory_cache.get(memory_cache_key)
+            if cached_tile is not None:
+                return cached_tile
+
+        async def cut_tile():
+            shift = z - manifest.maxzoom
+            parent_tile = await load_tile(tileset, manifest, manifest.maxzoom, x >> shift, y >> shift)
+            if parent_tile is None:
+                return None
+            tile_data = await tile_pool.run(
+                tile_utils.overzoom_tile, parent_tile[0], x, y, z, manifest.maxzoom, manifest.extent, manifest.tile_buffer)
+            if tile_data is None:
+                return None
+            etag = content_etag(tile_data)
+            if memory_cache is not None:
+                memory_cache.put(memory_cache_key, tile_data, etag)
+            return tile_data, etag
+
+        return await tile_flights.run(memory_cache_key, cut_tile)
 
     @app.get("/tilesets/{tileset}/tiles/{z}/{x}/{y}.mvt")
-    async def get_tile(tileset: str, z: int, x: int, y: int):
+    async def get_tile(tileset: str, z: int, x: int, y: int, request: Request):
         headers = {
             "content-type": "application/vnd.mapbox-vector-tile",
             "Cache-Control": 'no-cache, no-store'
         }
 
-        if tileset not in get_tilesets():
+        if tileset not in get_tilesets() or not tile_utils.is_valid_tile(x, y, z):
             return Response(status_code=404, headers=headers)
 
         manifest: TilesetManifest = get_tileset_manifest()[tileset]
 
-        if job_param.mode == 'serve_cache' or not job_param.disable_caching:
-            cached_data = read_cache(tileset, x, y, z)
-            if cached_data is not None:
-                return Response(content=cached_data, headers=headers)
-
-        # tile not found return 404 directly
-        if job_param.mode == 'serve_cache':
+        # requests outside the zoom range or the data are answered without touching the data
+        if z < manifest.minzoom or (z > manifest.maxzoom and not manifest.overzoom):
             return Response(status_code=404, headers=headers)
+        headers["Cache-Control"] = cache_control_header(manifest.get_max_age(job_param.mode))
+        mercator_bounds = tileset_registry.get_tileset_info(tileset).mercator_bounds
+        if not tile_utils.tile_intersects_bounds(mercator_bounds, x, y, z, manifest):
+            return Response(status_code=204, headers=headers)
 
-        tile_data = None
+        tile = None
         try:
-            tile_data = tile_utils.get_tile(tileset, x, y, z, manifest.extent)
-            if tile_data is None:
+            if z > manifest.maxzoom:
+                tile = await load_overzoomed_tile(tileset, manifest, z, x, y)
+            else:
+                tile = await load_tile(tileset, manifest, z, x, y)
+            if tile is None:
+                headers["Cache-Control"] = 'no-cache, no-store'
                 return Response(status_code=404, headers=headers)
 
         except TimeOutException:
             return timeout_response()
+        except PoolSaturatedException:
+            return overloaded_response()
 
-        # update cache
-        if not job_param.disable_caching:
-            update_cache(tileset, x, y, z, tile_data)
-        return Response(content=tile_data, headers=headers)
+        tile_data, etag = tile
+        return tile_response(request, tile_data, etag, headers)
+
+    @app.get("/stats")
+    async def get_stats():
+        headers = {
+            "content-type": "application/json",
+            "Cache-Control": 'no-cache, no-store'
+        }
+        memory_cache = get_memory_cache()
+        result = {
+            'memory_cache': memory_cache.stats() if memory_cache is not None else None,
+            'tile_generation': tile_flights.stats()
+        }
+        return Response(content=json.dumps(result), headers=headers)
 
     @app.get("/")
     async def index():
@@ -130,7 +248,10 @@ def start_api(job_param: JobParam):
 
         return result
 
-    uvicorn.run(app, host="0.0.0.0", port=int(job_param.port))
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=int(job_param.port))
+    finally:
+        tile_pool.shutdown()
 
 
 def start_tiller_process(job_param: JobParam):
@@ -140,6 +261,11 @@ def start_tiller_process(job_param: JobParam):
     print('cache_folder:', job_param.cache_folder)
     print('port:', job_param.port)
     print('tile_timeout:', job_param.tile_timeout)
+    print('tile_workers:', job_param.tile_workers, job_param.tile_executor)
+    print('memory_cache_mb:', job_param.memory_cache_mb)
+    print('cache_format:', job_param.cache_format)
+    print('ogr_reader:', job_param.ogr_reader)
+    print('prepare_sources:', job_param.prepare_sources)
 
     if job_param.mode == 'serve' or job_param.mode == 'serve_cache':
         print('Web UI started')
@@ -147,9 +273,15 @@ def start_tiller_process(job_param: JobParam):
         print('Web UI stopped')
     elif job_param.mode == 'build_cache':
         # job to build cache
+        print('build_mode:', job_param.build_mode)
+        print('workers:', job_param.workers, 'split_zoom:', job_param.split_zoom)
         print('started...')
         build_cache(job_param)
         print('completed...')
+    elif job_param.mode == 'prepare':
+        # job to write web mercator copies of the datasets
+        tilesets = setup_ogr_cache(job_param.data_folder)
+        prepare_sources(job_param.data_folder, job_param.cache_folder, tilesets, force=True)
     print('completed')
 
 
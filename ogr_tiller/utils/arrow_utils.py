@@ -0,0 +1,65 @@
+import datetime
+from functools import lru_cache
+from typing import Any, List, Tuple
+import numpy as np
+import shapely
+from ogr_tiller.poco.layer_features import LayerFeatures
+from rich import print
+
+# optional batched reads through pyogrio and pyarrow, selected with --ogr_reader arrow
+try:
+    import pyogrio
+    import pyarrow
+except ImportError:
+    pyogrio = None
+
+ogr_reader = 'fiona'
+
+
+def setup_ogr_reader(reader: str):
+    global ogr_reader
+    if reader not in ['fiona', 'arrow']:
+        raise ValueError(f'unknown ogr reader {reader}')
+    if reader == 'arrow' and pyogrio is None:
+        print('[red]pyogrio and pyarrow are needed for --ogr_reader arrow, reading with fiona[/red]')
+        reader = 'fiona'
+    ogr_reader = reader
+
+
+def use_arrow_reader() -> bool:
+    return ogr_reader == 'arrow'
+
+
+def list_layer_names(ds_path: str) -> List[str]:
+    return list(pyogrio.list_layers(ds_path)[:, 0])
+
+
+@lru_cache(maxsize=256)
+def get_layer_crs(ds_path: str, mtime: float, layer_name: str):
+    # the crs is needed to transform the bbox before reading, mtime invalidates the entry
+    return pyogrio.read_info(ds_path, layer=layer_name)['crs']
+
+
+def to_python_values(column) -> np.ndarray:
+    # same values fiona returns: None for nulls, dates and times as iso strings
+    values = column.to_pylist()
+    if pyarrow.types.is_temporal(column.type):
+        values = [value.isoformat() if isinstance(value, (datetime.date, datetime.time)) else value for value in values]
+    result = np.empty(len(values), dtype=object)
+    result[:] = values
+    return result
+
+
+def read_layer_features(ds_path: str, layer_name: str, bbox: Any = None,
+                        columns: List[str] = None, where: str = None) -> Tuple[Any, LayerFeatures]:
+    # (crs, features) of one layer, geometries are decoded from wkb in one call
+    meta, table = pyogrio.read_arrow(ds_path, layer=layer_name, bbox=tuple(bbox) if bbox is not None else None,
+                                     columns=columns, where=where)
+    geometry_name = meta['geometry_name'] or 'wkb_geometry'
+    geometries = shapely.from_wkb(table[geometry_name].to_numpy(zero_copy_only=False))
+    has_geometry = ~shapely.is_missing(geometries)
+    properties = {
+        field: to_python_values(table[field])[has_geometry]
+        for field in meta['fields']
+    }
+    return meta['crs'], LayerFeatures(layer_name, geometries[has_geometry], properties)
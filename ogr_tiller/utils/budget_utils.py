@@ -0,0 +1,186 @@
+import math
+from typing import Callable, List
+import numpy as np
+import shapely
+from ogr_tiller.poco.layer_features import LayerFeatures
+from ogr_tiller.poco.layer_manifest import LayerManifest
+from ogr_tiller.poco.tileset_manifest import TilesetManifest
+
+# feature and byte budgets of a tile, layers over budget are thinned before encoding
+
+STRATEGIES = ['drop_densest', 'cluster', 'drop_smallest']
+# encodes of one tile before it is written over its byte budget, layers measured on their own included
+MAX_ENCODES = 4
+# cells per side of the finest grid tried when clustering points
+MAX_CLUSTER_GRID = 1 << 16
+# layers are cut a bit below the measured ratio, sizes do not shrink linearly
+BYTES_MARGIN = 0.9
+
+
+def is_point_layer(layer: LayerFeatures) -> bool:
+    return bool(np.isin(shapely.get_type_id(layer.geometries), [0, 4]).all())
+
+
+def grid_cells(layer: LayerFeatures, bbox, cells_per_side: int) -> np.ndarray:
+    # cell of the representative point of each feature in a grid over the tile
+    return point_cells(shapely.get_coordinates(shapely.point_on_surface(layer.geometries)), bbox, cells_per_side)
+
+
+def point_cells(points: np.ndarray, bbox, cells_per_side: int) -> np.ndarray:
+    minx, miny, maxx, maxy = bbox
+    column = np.clip(((points[:, 0] - minx) / (maxx - minx) * cells_per_side).astype(np.int64), 0, cells_per_side - 1)
+    row = np.clip(((points[:, 1] - miny) / (maxy - miny) * cells_per_side).astype(np.int64), 0, cells_per_side - 1)
+    return row * cells_per_side + column
+
+
+def drop_densest(layer: LayerFeatures, max_features: int, bbox) -> LayerFeatures:
+    # every grid cell keeps its first feature before any cell keeps a second one,
+    # so features are dropped from the densest areas first
+    cells = grid_cells(layer, bbox, max(1, math.ceil(math.sqrt(max_features))))
+    order = np.argsort(cells, kind='stable')
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    ranks = np.empty(len(cells), dtype=np.int64)
+    ranks[order] = np.arange(len(cells)) - np.repeat(starts, np.diff(np.r_[starts, len(cells)]))
+    keep = np.lexsort((np.arange(len(cells)), ranks))[:max_features]
+    return layer.take(np.sort(keep))
+
+
+def cluster_cells(points: np.ndarray, max_features: int) -> np.ndarray:
+    # cells of the finest grid over the extent of the points with at most max_features
+    # occupied cells, so points in a small part of the tile still fill the budget.
+    # cells per side double until a grid has too many clusters, then a binary search
+    # narrows down between the last two grids. a single cell always fits.
+    minx, miny = points.min(axis=0)
+    maxx, maxy = points.max(axis=0)
+    bbox = (minx, miny, max(maxx, minx + 1), max(maxy, miny + 1))
+    best = np.zeros(len(points), dtype=np.int64)
+    low, high = 1, None
+    cells_per_side = max(2, math.isqrt(max_features))
+    while True:
+        cells = point_cells(points, bbox, cells_per_side)
+        if len(np.unique(cells)) <= max_features:
+            low, best = cells_per_side, cells
+        else:
+            high = cells_per_side
+        if high is None:
+            if cells_per_side >= MAX_CLUSTER_GRID:
+                return best
+            cells_per_side *= 2
+        else:
+            if high - low <= 1:
+                return best
+            cells_per_side = (low + high) // 2
+
+
+def cluster_points(layer: LayerFeatures, max_features: int) -> LayerFeatures:
+    # points sharing a grid cell become one point at their mean position, with the
+    # properties of the first point and the number of points in point_count
+    points = shapely.get_coordinates(shapely.point_on_surface(layer.geometries))
+    _, first, inverse = np.unique(cluster_cells(points, max_features), return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # clusters of clusters add up their counts
+    weights = np.ones(len(layer))
+    if 'point_count' in layer.properties:
+        weights = np.array([count or 1 for count in layer.properties['point_count']], dtype=np.float64)
+    counts = np.bincount(inverse, weights=weights)
+    x = np.bincount(inverse, weights=points[:, 0] * weights) / counts
+    y = np.bincount(inverse, weights=points[:, 1] * weights) / counts
+    # keep the order of the first point of each cluster
+    order = np.argsort(first)
+    clustered = layer.take(first[order])
+    clustered.geometries = shapely.points(x[order], y[order])
+    # like other cluster sources, points which are not clustered carry no point_count
+    point_count = np.empty(len(order), dtype=object)
+    point_count[:] = [int(count) if count > 1 else None for count in counts[order]]
+    clustered.properties['point_count'] = point_count
+    return clustered
+
+
+def drop_smallest(layer: LayerFeatures, max_features: int) -> LayerFeatures:
+    # largest polygons by area and lines by length are kept
+    area = shapely.area(layer.geometries)
+    size = np.where(area > 0, area, shapely.length(layer.geometries))
+    keep = np.argsort(-size, kind='stable')[:max_features]
+    return layer.take(np.sort(keep))
+
+
+def thin_layer(layer: LayerFeatures, max_features: int, strategy: str, bbox) -> LayerFeatures:
+    if len(layer) <= max_features:
+        return layer
+    if max_features <= 0:
+        return layer.take(np.zeros(len(layer), dtype=bool))
+    if strategy is None:
+        strategy = 'drop_densest' if is_point_layer(layer) else 'drop_smallest'
+    if strategy == 'cluster' and is_point_layer(layer):
+        return cluster_points(layer, max_features)
+    if strategy == 'drop_smallest' and not is_point_layer(layer):
+        return drop_smallest(layer, max_features)
+    # points can not be dropped by size, and only points are clustered
+    return drop_densest(layer, max_features, bbox)
+
+
+def apply_feature_budgets(layer_features: List[LayerFeatures], manifest: TilesetManifest, bbox) -> List[LayerFeatures]:
+    result = []
+    for layer in layer_features:
+        layer_manifest = manifest.get_layer_manifest(layer.name)
+        if layer_manifest.max_features is not None:
+            layer = thin_layer(layer, layer_manifest.max_features, layer_manifest.strategy, bbox)
+        result.append(layer)
+
+    # the tile budget is shared by the layers in proportion to their features
+    total = sum(len(layer) for layer in result)
+    if manifest.max_features is not None and total > manifest.max_features:
+        result = scale_layers(result, manifest, manifest.max_features / total, bbox)
+    return result
+
+
+def scale_layers(layer_features: List[LayerFeatures], manifest: TilesetManifest, ratio: float, bbox, layer_names=None) -> List[LayerFeatures]:
+    result = []
+    for layer in layer_features:
+        if layer_names is None or layer.name in layer_names:
+            layer_manifest: LayerManifest = manifest.get_layer_manifest(layer.name)
+            layer = thin_layer(layer, int(len(layer) * ratio), layer_manifest.strategy, bbox)
+        result.append(layer)
+    return result
+
+
+def apply_layer_byte_budgets(layer_features: List[LayerFeatures], manifest: TilesetManifest, bbox,
+                             encode: Callable[[List[LayerFeatures]], bytes], max_encodes: int):
+    # layers over their byte budget are measured on their own, with at most max_encodes encodes.
+    # returns the layers, if any was thinned and the number of encodes.
+    thinned = False
+    encodes = 0
+    for layer in list(layer_features):
+        max_bytes = manifest.get_layer_manifest(layer.name).max_bytes
+        if max_bytes is None or len(layer) == 0:
+            continue
+        if encodes >= max_encodes:
+            break
+        layer_size = len(encode([layer]))
+        encodes += 1
+        if layer_size > max_bytes:
+            thinned = True
+            layer_features = scale_layers(layer_features, manifest, max_bytes / layer_size * BYTES_MARGIN, bbox, [layer.name])
+    return layer_features, thinned, encodes
+
+
+def encode_within_budget(layer_features: List[LayerFeatures], manifest: TilesetManifest, bbox,
+                         encode: Callable[[List[LayerFeatures]], bytes]) -> bytes:
+    # sizes are of the uncompressed tile, the last encode is returned even when it is still over budget
+    if not manifest.has_budgets():
+        return encode(layer_features)
+    layer_features = apply_feature_budgets(layer_features, manifest, bbox)
+    encodes = 0
+    while True:
+        # the last encode is kept for the tile itself
+        layer_features, thinned, measured = apply_layer_byte_budgets(
+            layer_features, manifest, bbox, encode, MAX_ENCODES - 1 - encodes)
+        encodes += measured
+        if thinned and encodes < MAX_ENCODES - 1:
+            continue
+        tile_data = encode(layer_features)
+        encodes += 1
+        if manifest.max_bytes is None or len(tile_data) <= manifest.max_bytes or encodes >= MAX_ENCODES:
+            return tile_data
+        layer_features = scale_layers(layer_features, manifest, manifest.max_bytes / len(tile_data) * BYTES_MARGIN, bbox)
@@ -0,0 +1,181 @@
+import os
+import threading
+from typing import Any, Optional, Tuple
+from ogr_tiller.poco.job_param import JobParam
+from ogr_tiller.utils.directory_utils import DirectoryTileWriter, get_tile_folder, read_tile_file, remove_tile_folder, write_static_tilejson, write_tile_file
+from ogr_tiller.utils.pmtiles_utils import PMTilesReader, export_mbtiles_to_pmtiles
+from ogr_tiller.utils.sqlite_utils import TileBatchWriter, close_connection_managers, get_mbtile_path, read_cache, setup_mbtile_cache, tile_hash, update_cache
+from rich import print
+
+# storage of the cached tiles, selected with --cache_format
+cache_backend = None
+
+
+class CacheBackend:
+    """Where the cached tiles of all tilesets are read from and written to"""
+
+    def setup(self, tileset: str, cache_folder: str, tilejson: Any):
+        raise NotImplementedError()
+
+    def read_tile(self, tileset: str, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+        # (tile_data, tile_id), the tile id is the hash of the tile data
+        raise NotImplementedError()
+
+    def write_tile(self, tileset: str, x: int, y: int, z: int, tile_data: bytes):
+        raise NotImplementedError()
+
+    def finish_build(self, tileset: str):
+        # called by build_cache once every tile of the tileset is written
+        pass
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class MBTilesBackend(CacheBackend):
+    """One mbtiles file per tileset, tiles can be added while serving"""
+
+    def __init__(self, read_only: bool = False):
+        # serve_cache only reads, mbtiles files of other tools are served as they are
+        self.read_only = read_only
+
+    def setup(self, tileset: str, cache_folder: str, tilejson: Any):
+        setup_mbtile_cache(tileset, cache_folder, tilejson, read_only=self.read_only)
+
+    def read_tile(self, tileset: str, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+        return read_cache(tileset, x, y, z)
+
+    def write_tile(self, tileset: str, x: int, y: int, z: int, tile_data: bytes):
+        update_cache(tileset, x, y, z, tile_data)
+
+    def close(self):
+        close_connection_managers()
+
+
+class PMTilesBackend(CacheBackend):
+    """One read only PMTiles archive per tileset"""
+
+    # archives can not be appended to. build_cache stages the tiles in the mbtiles file,
+    # which keeps resume and incremental builds working, and exports the archive from it.
+
+    def __init__(self, build: bool):
+        self.build = build
+        self.cache_folder = None
+        self.tilejsons = {}
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def setup(self, tileset: str, cache_folder: str, tilejson: Any):
+        self.cache_folder = cache_folder
+        self.tilejsons[tileset] = tilejson
+        if self.build:
+            setup_mbtile_cache(tileset, cache_folder, tilejson)
+        self._open(tileset)
+
+    def _open(self, tileset: str):
+        with self.lock:
+            reader = self.readers.pop(tileset, None)
+            if reader is not None:
+                reader.close()
+            pmtiles_path = get_pmtiles_path(self.cache_folder, tileset)
+            if not os.path.isfile(pmtiles_path):
+                return
+            try:
+                self.readers[tileset] = PMTilesReader(pmtiles_path)
+            except Exception as e:
+                print(f'error opening {pmtiles_path}', e)
+
+    def read_tile(self, tileset: str, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+        reader = self.readers.get(tileset)
+        if reader is None:
+            return None
+        tile_data = reader.read_tile(z, x, y)
+        if tile_data is None:
+            return None
+        return tile_data, tile_hash(tile_data)
+
+    def write_tile(self, tileset: str, x: int, y: int, z: int, tile_data: bytes):
+        # dynamically generated tiles are only kept in the memory cache
+        pass
+
+    def finish_build(self, tileset: str):
+        pmtiles_path = get_pmtiles_path(self.cache_folder, tileset)
+        tile_count = export_mbtiles_to_pmtiles(
+            get_mbtile_path(self.cache_folder, tileset), pmtiles_path, self.tilejsons[tileset])
+        print(f'{tileset}: wrote {tile_count} tiles to {pmtiles_path}')
+        self._open(tileset)
+
+    def close(self):
+        with self.lock:
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
+        close_connection_managers()
+
+
+class DirectoryBackend(CacheBackend):
+    """A {z}/{x}/{y}.mvt tree of gzip compressed tiles per tileset, for static hosting"""
+
+    # build workers write the tiles straight into the tree. the mbtiles file only keeps
+    # the metadata and checkpoints, which keeps resume and incremental builds working.
+
+    def __init__(self, build: bool):
+        self.build = build
+        self.tile_folders = {}
+
+    def setup(self, tileset: str, cache_folder: str, tilejson: Any):
+        tile_folder = get_tile_folder(cache_folder, tileset)
+        self.tile_folders[tileset] = tile_folder
+        if self.build:
+            # without its build state the tree is stale (full builds, changed sources)
+            if not os.path.isfile(get_mbtile_path(cache_folder, tileset)):
+                remove_tile_folder(tile_folder)
+            setup_mbtile_cache(tileset, cache_folder, tilejson)
+        write_static_tilejson(tile_folder, tilejson)
+
+    def read_tile(self, tileset: str, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+        tile_folder = self.tile_folders.get(tileset)
+        if tile_folder is None:
+            return None
+        tile_data = read_tile_file(tile_folder, x, y, z)
+        if tile_data is None:
+            return None
+        return tile_data, tile_hash(tile_data)
+
+    def write_tile(self, tileset: str, x: int, y: int, z: int, tile_data: bytes):
+        tile_folder = self.tile_folders.get(tileset)
+        if tile_folder is not None:
+            write_tile_file(tile_folder, x, y, z, tile_data)
+
+    def close(self):
+        close_connection_managers()
+
+
+def open_tile_writer(job_param: JobParam, tileset: str):
+    # used by the build workers, which do not set up a cache backend
+    db_file = get_mbtile_path(job_param.cache_folder, tileset)
+    if job_param.cache_format == 'directory':
+        return DirectoryTileWriter(get_tile_folder(job_param.cache_folder, tileset), db_file)
+    return TileBatchWriter(db_file, job_param.batch_tiles, job_param.batch_mb * 1024 * 1024)
+
+
+def get_pmtiles_path(cache_folder: str, tileset: str) -> str:
+    return os.path.join(cache_folder, f'{tileset}.pmtiles')
+
+
+def setup_cache_backend(cache_format: str, mode: str):
+    global cache_backend
+    if cache_backend is not None:
+        cache_backend.close()
+    if cache_format == 'pmtiles':
+        cache_backend = PMTilesBackend(build=mode == 'build_cache')
+    elif cache_format == 'directory':
+        cache_backend = DirectoryBackend(build=mode == 'build_cache')
+    elif cache_format == 'mbtiles':
+        cache_backend = MBTilesBackend(read_only=mode == 'serve_cache')
+    else:
+        raise ValueError(f'unknown cache format {cache_format}')
+
+
+def get_cache_backend() -> CacheBackend:
+    return cache_backend
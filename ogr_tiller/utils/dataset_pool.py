@@ -0,0 +1,176 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, List, Tuple
+import fiona
+from ogr_tiller.poco.tileset_manifest import TilesetManifest
+from ogr_tiller.utils.ogr_utils import get_tileset_manifest
+from ogr_tiller.utils.prepare_utils import get_lod_options, get_lod_paths, get_prepared_folder, get_prepared_path, get_source_path, is_prepared_fresh
+from rich import print
+
+# open layer handles per tileset
+tileset_dataset_pools = {}
+# pools of the level of detail copies per tileset and zoom, with the prepared folder mtime they were listed at
+lod_cache_folder = None
+tileset_lod_pools = {}
+lod_pools_lock = threading.Lock()
+
+
+class DatasetPool:
+    """Opened fiona layer handles of one dataset, reused across tile requests"""
+
+    # fiona collections are not safe to share between threads, so every checkout
+    # gets its own set of layer handles. handles are dropped when the file changes.
+    # a fresh web mercator copy from the prepare step is read instead of the source.
+    # handles only read the fields in the property allowlists of the manifest.
+
+    def __init__(self, ds_path: str, max_idle: int = 8, prepared_path: str = None, manifest: TilesetManifest = None):
+        self.ds_path = ds_path
+        self.prepared_path = prepared_path
+        self.manifest = manifest
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.source_path = None
+        self.mtime = None
+        self.generation = 0
+        self.layer_names: List[str] = []
+        self.idle: List[List[Tuple[str, Any]]] = []
+
+    def _refresh(self):
+        # caller holds the lock
+        source_path = get_source_path(self.ds_path, self.prepared_path, self.manifest)
+        mtime = os.path.getmtime(source_path)
+        if source_path == self.source_path and mtime == self.mtime:
+            return
+        self._close_idle()
+        self.source_path = source_path
+        self.mtime = mtime
+        self.layer_names = fiona.listlayers(source_path)
+        self.generation += 1
+
+    def _open(self, source_path: str, layer_names: List[str]) -> List[Tuple[str, Any]]:
+        return [
+            (layer_name, fiona.open(source_path, 'r', layer=layer_name, include_fields=self.get_properties(layer_name)))
+            for layer_name in layer_names
+        ]
+
+    def get_properties(self, layer_name: str) -> List[str]:
+        if self.manifest is None:
+            return None
+        return self.manifest.get_layer_manifest(layer_name).properties
+
+    def _close_idle(self):
+        for handles in self.idle:
+            close_handles(handles)
+        self.idle = []
+
+    def source(self) -> Tuple[str, List[str]]:
+        # (path, layer names) of the file to read, for readers opening the dataset themselves
+        with self.lock:
+            self._refresh()
+            return self.source_path, self.layer_names
+
+    @contextmanager
+    def layers(self):
+        with self.lock:
+            self._refresh()
+            generation = self.generation
+            source_path = self.source_path
+            layer_names = self.layer_names
+            handles = self.idle.pop() if len(self.idle) > 0 else None
+
+        if handles is None:
+            handles = self._open(source_path, layer_names)
+
+        try:
+            yield handles
+        except:
+            close_handles(handles)
+            raise
+
+        with self.lock:
+            keep = generation == self.generation and len(self.idle) < self.max_idle
+            if keep:
+                self.idle.append(handles)
+        if not keep:
+            close_handles(handles)
+
+    def close(self):
+        with self.lock:
+            self._close_idle()
+            self.source_path = None
+            self.mtime = None
+
+
+def close_handles(handles: List[Tuple[str, Any]]):
+    for layer_name, layer in handles:
+        try:
+            layer.close()
+        except Exception as e:
+            print(f'error closing {layer_name}', e)
+
+
+def setup_dataset_pools(data_folder: str, tilesets: List[str], cache_folder: str = None):
+    global tileset_dataset_pools, tileset_lod_pools, lod_cache_folder
+    close_dataset_pools()
+    manifests = get_tileset_manifest()
+    tileset_dataset_pools = {
+        tileset: DatasetPool(
+            os.path.join(data_folder, f'{tileset}.gpkg'),
+            prepared_path=get_prepared_path(cache_folder, tileset) if cache_folder is not None else None,
+            manifest=manifests[tileset])
+        for tileset in tilesets
+    }
+    lod_cache_folder = cache_folder
+    tileset_lod_pools = {}
+
+
+def close_dataset_pools():
+    for pool in tileset_dataset_pools.values():
+        pool.close()
+    for mtime, lod_pools in tileset_lod_pools.values():
+        for zoom, pool in lod_pools:
+            pool.close()
+
+
+def get_lod_pools(tileset: str) -> List[Tuple[int, DatasetPool]]:
+    # copies are listed again when files are added, replaced or removed in the prepared folder,
+    # so a prepare run next to a running server is picked up. pools of kept copies are reused.
+    manifest = get_tileset_manifest()[tileset]
+    if lod_cache_folder is None or not manifest.lod:
+        return []
+    prepared_folder = get_prepared_folder(lod_cache_folder)
+    mtime = os.path.getmtime(prepared_folder) if os.path.isdir(prepared_folder) else None
+    listed = tileset_lod_pools.get(tileset)
+    if listed is not None and listed[0] == mtime:
+        return listed[1]
+    with lod_pools_lock:
+        listed = tileset_lod_pools.get(tileset)
+        if listed is not None and listed[0] == mtime:
+            return listed[1]
+        previous = {pool.ds_path: (zoom, pool) for zoom, pool in listed[1]} if listed is not None else {}
+        lod_pools = []
+        for zoom, lod_path in sorted(get_lod_paths(lod_cache_folder, tileset).items()):
+            lod_pools.append(previous.pop(lod_path, None) or (zoom, DatasetPool(lod_path, manifest=manifest)))
+        for zoom, pool in previous.values():
+            pool.close()
+        tileset_lod_pools[tileset] = (mtime, lod_pools)
+        return lod_pools
+
+
+atexit.register(close_dataset_pools)
+
+
+def get_dataset_pool(tileset: str, zoom: int = None) -> DatasetPool:
+    pool = tileset_dataset_pools[tileset]
+    if zoom is None:
+        return pool
+    # the coarsest level still simplified less than the tiles of the zoom, levels
+    # of finer zooms have smaller tolerances. stale levels are not read.
+    for lod_zoom, lod_pool in get_lod_pools(tileset):
+        if lod_zoom >= zoom:
+            if is_prepared_fresh(pool.ds_path, lod_pool.ds_path, get_lod_options(lod_pool.manifest)):
+                return lod_pool
+            break
+    return pool
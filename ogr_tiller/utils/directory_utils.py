@@ -0,0 +1,107 @@
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from typing import Any, List, Optional
+from ogr_tiller.utils.sqlite_utils import CHECKPOINT_TABLE_SQL
+
+# {cache_folder}/tiles/{tileset}/{z}/{x}/{y}.mvt trees of gzip compressed tiles for static hosting.
+# the trees have their own folder, so no tileset name can clash with the prepared folder.
+
+
+def get_tiles_folder(cache_folder: str) -> str:
+    return os.path.join(cache_folder, 'tiles')
+
+
+def get_tile_folder(cache_folder: str, tileset: str) -> str:
+    return os.path.join(get_tiles_folder(cache_folder), tileset)
+
+
+def get_tile_file_path(tile_folder: str, x: int, y: int, z: int) -> str:
+    return os.path.join(tile_folder, str(z), str(x), f'{y}.mvt')
+
+
+def write_file_atomic(path: str, content: bytes):
+    # written next to the final file and renamed, a web server never sees a partial file
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_tile_file(tile_folder: str, x: int, y: int, z: int) -> Optional[bytes]:
+    try:
+        with open(get_tile_file_path(tile_folder, x, y, z), 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_tile_file(tile_folder: str, x: int, y: int, z: int, tile_data: bytes):
+    write_file_atomic(get_tile_file_path(tile_folder, x, y, z), tile_data)
+
+
+def write_static_tilejson(tile_folder: str, tilejson: Any):
+    # tile urls are relative to the tileset folder, the host serving the tree is not known here
+    static_tilejson = dict(tilejson)
+    static_tilejson['tiles'] = ['{z}/{x}/{y}.mvt']
+    write_file_atomic(os.path.join(tile_folder, 'tile.json'), json.dumps(static_tilejson).encode())
+
+
+def remove_tile_folder(tile_folder: str):
+    if os.path.isdir(tile_folder):
+        shutil.rmtree(tile_folder)
+
+
+def cleanup_orphan_tile_folders(cache_folder: str, tilesets: List[str]):
+    # tile trees of tilesets which are no longer in the data folder
+    for tilejson_path in glob.glob(os.path.join(glob.escape(get_tiles_folder(cache_folder)), '*', 'tile.json')):
+        tile_folder = os.path.dirname(tilejson_path)
+        if os.path.basename(tile_folder) not in tilesets:
+            remove_tile_folder(tile_folder)
+
+
+class DirectoryTileWriter:
+    """Writes generated tiles as files, build checkpoints are kept in the mbtiles file of the tileset"""
+
+    def __init__(self, tile_folder: str, db_file: str):
+        self.tile_folder = tile_folder
+        self.db_file = db_file
+        self.count = 0
+        # tiles which failed to generate, a subtree with failures is not checkpointed
+        self.errors = 0
+
+    def add(self, x: int, y: int, z: int, tile_data: Any):
+        write_tile_file(self.tile_folder, x, y, z, tile_data)
+        self.count += 1
+
+    def flush(self):
+        pass
+
+    def checkpoint(self, x: int, y: int, z: int, max_zoom: int):
+        # every tile of the subtree is already renamed into place
+        conn = sqlite3.connect(self.db_file, timeout=60)
+        try:
+            with conn:
+                conn.execute(CHECKPOINT_TABLE_SQL)
+                conn.execute('INSERT OR REPLACE INTO build_checkpoints(x,y,z,max_zoom) VALUES(?,?,?,?);', (x, y, z, max_zoom))
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
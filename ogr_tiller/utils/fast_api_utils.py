@@ -1,14 +1,20 @@
-import functools
-import signal
-import sys
+import hashlib
+import threading
+import time
+from typing import Optional
 
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
 from starlette import status
-from rich import print
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
 
 # max_execution_time in seconds
 TILE_TIMEOUT = None
 
+# deadline of the tile being generated on the current worker thread
+deadline_state = threading.local()
+
 def set_tile_timeout(timeout: int):
     global TILE_TIMEOUT
     TILE_TIMEOUT = timeout
@@ -17,23 +23,72 @@ class TimeOutException(Exception):
     """It took longer than expected"""
 
 
-def abort_after():
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            def handle_timeout(signum, frame):
-                raise TimeOutException(f"Function execution took longer than {TILE_TIMEOUT}s and was terminated")
-            if sys.platform == 'win32':
-                print("Won't be stopped in windows!")
-            else:
-                signal.signal(signal.SIGALRM, handle_timeout)
-                signal.alarm(TILE_TIMEOUT)
-            result = func(*args, **kwargs)
-            if sys.platform != 'win32':
-                signal.alarm(0)
-            return result
-        return wrapper
-    return decorator
+def set_deadline(deadline: float):
+    deadline_state.deadline = deadline
+
+
+def check_deadline():
+    # called between the stages of tile generation so abandoned work stops early
+    deadline = getattr(deadline_state, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise TimeOutException(f"Function execution took longer than {TILE_TIMEOUT}s and was terminated")
+
+
+def content_etag(content: bytes) -> str:
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match holds one or more, possibly weak, etags or *
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    # Accept-Encoding lists codings with optional q-values, q=0 means not acceptable.
+    # gzip is accepted when it or * is listed with a q-value above 0, gzip taking precedence.
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    for coding in ['gzip', 'x-gzip', '*']:
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+class AcceptEncodingGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware which also leaves the response alone when gzip is refused with q=0"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and not accepts_gzip(Headers(scope=scope).get("accept-encoding")):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+def cache_control_header(max_age: int) -> str:
+    # without a max age clients still cache, but revalidate with the etag every time
+    if max_age is not None and max_age > 0:
+        return f'public, max-age={max_age}'
+    return 'no-cache'
 
 
 def timeout_response() -> JSONResponse:
@@ -47,3 +102,17 @@ def timeout_response() -> JSONResponse:
         status_code=status.HTTP_504_GATEWAY_TIMEOUT,
         headers=headers
     )
+
+
+def overloaded_response() -> JSONResponse:
+    headers = {
+        "Cache-Control": 'no-cache, no-store',
+        "Retry-After": '1'
+    }
+    return JSONResponse(
+        {
+            'detail': 'Server is busy generating other tiles',
+        },
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers=headers
+    )
@@ -1,24 +1,52 @@
 from ogr_tiller.poco.job_param import JobParam
-from ogr_tiller.poco.tileset_manifest import TilesetManifest
+from ogr_tiller.utils.arrow_utils import setup_ogr_reader
+from ogr_tiller.utils.dataset_pool import setup_dataset_pools
 from ogr_tiller.utils.fast_api_utils import set_tile_timeout
-from ogr_tiller.utils.ogr_utils import get_tile_json, get_tileset_manifest, setup_ogr_cache, setup_stylesheet_cache
-from ogr_tiller.utils.sqlite_utils import setup_mbtile_cache
+from ogr_tiller.utils.memory_cache import setup_memory_cache
+from ogr_tiller.utils.ogr_utils import setup_ogr_cache, setup_stylesheet_cache
+from ogr_tiller.utils.prepare_utils import prepare_sources
+from ogr_tiller.utils.cache_backend import get_cache_backend, setup_cache_backend
+from ogr_tiller.utils.tileset_registry import get_tileset_info, setup_tileset_registry
 
 
 
 def common(job_param: JobParam):
     tilesets = setup_ogr_cache(job_param.data_folder)
 
-    # setup mbtile cache
+    # web mercator copies of the datasets
+    if job_param.prepare_sources and job_param.mode != 'serve_cache':
+        prepare_sources(job_param.data_folder, job_param.cache_folder, tilesets)
+
+    # fiona or arrow reads of the features
+    setup_ogr_reader(job_param.ogr_reader)
+
+    # reusable layer handles for dynamic tiles
+    setup_dataset_pools(job_param.data_folder, tilesets, job_param.cache_folder)
+
+    # tilejson and layer metadata of every tileset
+    setup_tileset_registry(job_param.port, tilesets)
+
+    # setup tile cache
+    setup_cache_backend(job_param.cache_format, job_param.mode)
     if not job_param.disable_caching:
         for tileset in tilesets:
-            manifest: TilesetManifest = get_tileset_manifest()[tileset]
-            tilejson = get_tile_json(tileset, job_param.port, manifest)
-            setup_mbtile_cache(tileset, job_param.cache_folder, tilejson)
+            tilejson = get_tileset_info(tileset).tilejson
+            get_cache_backend().setup(tileset, job_param.cache_folder, tilejson)
     
 
     # set tile timeout 
     set_tile_timeout(job_param.tile_timeout)
 
+    # in memory cache of encoded tiles
+    setup_memory_cache(job_param.memory_cache_mb)
+
     # user stylesheets
     setup_stylesheet_cache(job_param.stylesheet_folder)
+
+
+def setup_tile_worker(job_param: JobParam):
+    # initializer of tile worker processes, only what tile generation needs
+    tilesets = setup_ogr_cache(job_param.data_folder)
+    setup_ogr_reader(job_param.ogr_reader)
+    setup_dataset_pools(job_param.data_folder, tilesets, job_param.cache_folder)
+    set_tile_timeout(job_param.tile_timeout)
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+# process local cache of encoded tiles
+tile_memory_cache = None
+
+
+class TileMemoryCache:
+    """LRU cache of encoded tiles and their etags bounded by the total size of the tiles in bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, int, int, int]) -> Optional[Tuple[bytes, str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Tuple[str, int, int, int], tile_data: bytes, etag: str):
+        if tile_data is None or len(tile_data) > self.max_bytes:
+            return
+        with self.lock:
+            existing = self.entries.pop(key, None)
+            if existing is not None:
+                self.size -= len(existing[0])
+            self.entries[key] = (tile_data, etag)
+            self.size += len(tile_data)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self, tileset: str = None):
+        with self.lock:
+            if tileset is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for key in [key for key in self.entries if key[0] == tileset]:
+                self.size -= len(self.entries.pop(key)[0])
+
+    def stats(self) -> Any:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'tiles': len(self.entries),
+                'size_bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / requests if requests > 0 else None
+            }
+
+
+def setup_memory_cache(max_mb: int):
+    global tile_memory_cache
+    tile_memory_cache = None
+    if max_mb > 0:
+        tile_memory_cache = TileMemoryCache(max_mb * 1024 * 1024)
+
+
+def get_memory_cache() -> Optional[TileMemoryCache]:
+    return tile_memory_cache
@@ -1,9 +1,10 @@
-from typing import Any, List
+from typing import Any, Dict, List, Tuple
 import fiona
-from shapely.geometry import box, shape
+from shapely.geometry import shape
 import os
+from ogr_tiller.poco.layer_manifest import LayerManifest
 from ogr_tiller.poco.tileset_manifest import TilesetManifest
-from ogr_tiller.utils.fast_api_utils import abort_after
+from ogr_tiller.utils.budget_utils import STRATEGIES
 from ogr_tiller.utils.proj_utils import get_bbox_for_crs
 import yaml
 import json
@@ -31,6 +32,46 @@ def get_stylesheets():
     return cached_user_stylesheets
 
 
+def parse_max_age(value, current: Dict[str, int]) -> Dict[str, int]:
+    # a number applies to every serving mode, a mapping overrides single modes
+    if type(value) is dict:
+        result = dict(current)
+        result.update({mode: int(max_age) for mode, max_age in value.items()})
+        return result
+    return {mode: int(value) for mode in current.keys()}
+
+
+def parse_layer_manifests(value, current: Dict[str, LayerManifest]) -> Dict[str, LayerManifest]:
+    # budgets per layer name, settings of a tileset override the defaults one by one
+    result = dict(current)
+    if type(value) is not dict:
+        return result
+    for layer_name, layer_config in value.items():
+        if type(layer_config) is not dict:
+            continue
+        existing = result.get(layer_name, LayerManifest(layer_name))
+        layer_manifest = LayerManifest(layer_name, existing.max_features, existing.max_bytes, existing.strategy,
+                                       existing.properties, existing.filters)
+        if layer_config.get('max_features') is not None:
+            layer_manifest.max_features = int(layer_config['max_features'])
+        if layer_config.get('max_bytes') is not None:
+            layer_manifest.max_bytes = int(layer_config['max_bytes'])
+        if layer_config.get('strategy') is not None:
+            if layer_config['strategy'] in STRATEGIES:
+                layer_manifest.strategy = layer_config['strategy']
+            else:
+                print(f'[red]unknown strategy {layer_config["strategy"]} for layer {layer_name}, expected one of {STRATEGIES}[/red]')
+        if layer_config.get('properties') is not None:
+            layer_manifest.properties = [str(field) for field in layer_config['properties']]
+        if layer_config.get('filters') is not None:
+            layer_manifest.filters = [
+                (int(layer_filter.get('minzoom', 0)), int(layer_filter.get('maxzoom', 30)), str(layer_filter['where']))
+                for layer_filter in layer_config['filters'] if type(layer_filter) is dict and layer_filter.get('where')
+            ]
+        result[layer_name] = layer_manifest
+    return result
+
+
 def tileset_manifest(tilesets):
     result = {}
     for tileset in tilesets:
@@ -67,6 +108,20 @@ def tileset_manifest(tilesets):
                         manifest.simplify_tolerance = defaults['simplify_tolerance']
                     if 'extent' in defaults and defaults['extent']:
                         manifest.extent = defaults['extent']
+                    if 'overzoom' in defaults and defaults['overzoom'] is not None:
+                        manifest.overzoom = bool(defaults['overzoom'])
+                    if 'max_age' in defaults and defaults['max_age'] is not None:
+                        manifest.max_age = parse_max_age(defaults['max_age'], manifest.max_age)
+                    if 'lod' in defaults and defaults['lod'] is not None:
+                        manifest.lod = bool(defaults['lod'])
+                    if 'polylabel' in defaults and defaults['polylabel'] is not None:
+                        manifest.polylabel = bool(defaults['polylabel'])
+                    if 'max_features' in defaults and defaults['max_features'] is not None:
+                        manifest.max_features = int(defaults['max_features'])
+                    if 'max_bytes' in defaults and defaults['max_bytes'] is not None:
+                        manifest.max_bytes = int(defaults['max_bytes'])
+                    if 'layers' in defaults and defaults['layers'] is not None:
+                        manifest.layers = parse_layer_manifests(defaults['layers'], manifest.layers)
             if "config" in partial_manifest and "tilesets" in partial_manifest["config"] and type(partial_manifest["config"]["tilesets"]) is dict:
                 current_config = partial_manifest["config"]["tilesets"]
                 current_config_keys = current_config.keys()
@@ -81,6 +136,20 @@ def tileset_manifest(tilesets):
                         manifest.maxzoom = new_partial_manifest['maxzoom']
                     if 'attribution' in new_partial_manifest and new_partial_manifest['attribution']:
                         manifest.attribution = new_partial_manifest['attribution']
+                    if 'overzoom' in new_partial_manifest and new_partial_manifest['overzoom'] is not None:
+                        manifest.overzoom = bool(new_partial_manifest['overzoom'])
+                    if 'max_age' in new_partial_manifest and new_partial_manifest['max_age'] is not None:
+                        manifest.max_age = parse_max_age(new_partial_manifest['max_age'], manifest.max_age)
+                    if 'lod' in new_partial_manifest and new_partial_manifest['lod'] is not None:
+                        manifest.lod = bool(new_partial_manifest['lod'])
+                    if 'polylabel' in new_partial_manifest and new_partial_manifest['polylabel'] is not None:
+                        manifest.polylabel = bool(new_partial_manifest['polylabel'])
+                    if 'max_features' in new_partial_manifest and new_partial_manifest['max_features'] is not None:
+                        manifest.max_features = int(new_partial_manifest['max_features'])
+                    if 'max_bytes' in new_partial_manifest and new_partial_manifest['max_bytes'] is not None:
+                        manifest.max_bytes = int(new_partial_manifest['max_bytes'])
+                    if 'layers' in new_partial_manifest and new_partial_manifest['layers'] is not None:
+                        manifest.layers = parse_layer_manifests(new_partial_manifest['layers'], manifest.layers)
     print('mmanifest', result)
     return result
 
@@ -119,6 +188,12 @@ def format_field_type(name: str):
 
 
 def get_tile_json(tileset: str, port: str, tileset_manifest: TilesetManifest) -> Any:
+    tilejson, layer_geometry_types = read_tileset_metadata(tileset, port, tileset_manifest)
+    return tilejson
+
+
+def read_tileset_metadata(tileset: str, port: str, tileset_manifest: TilesetManifest) -> Tuple[Any, List[Tuple[str, str]]]:
+    # tilejson and [(layer_name, geometry_type)] from a single pass over the layers
     result = {
         'tilejson': '3.0.0',
         'id': tileset_manifest.name,
@@ -138,6 +213,7 @@ def get_tile_json(tileset: str, port: str, tileset_manifest: TilesetManifest) ->
     layers = fiona.listlayers(ds_path)
 
     vector_layers = []
+    layer_geometry_types = []
     for layer_name in layers:
         fields = {}
         geometry_type = None
@@ -156,17 +232,24 @@ def get_tile_json(tileset: str, port: str, tileset_manifest: TilesetManifest) ->
                 if result['bounds'] is None:
                     result['bounds'] = [minx, miny, maxx, maxy]
                 else:
-                    existing_bbox = box(*result['bounds'])
-                    minx_new, miny_new, maxx_new, maxy_new = existing_bbox.union(
-                        box(minx, miny, maxx, maxy)).bounds
-                    result['bounds'] = [minx_new, miny_new, maxx_new, maxy_new]
+                    existing = result['bounds']
+                    result['bounds'] = [min(existing[0], minx), min(existing[1], miny),
+                                        max(existing[2], maxx), max(existing[3], maxy)]
             except:
                 print(f'error getting bounds for {layer_name}')
+        layer_manifest = tileset_manifest.get_layer_manifest(layer_name)
+        if layer_manifest.properties is not None:
+            allowed = [format_field_name(field_name) for field_name in layer_manifest.properties]
+            fields = {field_name: field_type for field_name, field_type in fields.items() if field_name in allowed}
+        layer_fields = fields
+        if layer_manifest.strategy == 'cluster':
+            layer_fields = dict(fields, point_count='int')
         vector_layers.append({
             'id': layer_name,
-            'fields': fields,
+            'fields': layer_fields,
             'geometryType': geometry_type
         })
+        layer_geometry_types.append((layer_name, geometry_type))
 
         # include label point layer if it is polygon
         if geometry_type in ['Polygon', '3D Polygon', 'MultiPolygon', '3D MultiPolygon', 'UnKnown']:
@@ -187,14 +270,4 @@ def get_tile_json(tileset: str, port: str, tileset_manifest: TilesetManifest) ->
     else:
         result['center'] = None
 
-    return result
-
-
-
-
-
-
-
-
-
-
+    return result, layer_geometry_types
@@ -0,0 +1,278 @@
+import bisect
+import gzip
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+# PMTiles v3 single file archives, see https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+HEADER_SIZE = 127
+# header and root directory have to fit in the first 16 KiB
+ROOT_DIRECTORY_SIZE = 16384 - HEADER_SIZE
+COMPRESSION_GZIP = 2
+TILE_TYPE_MVT = 1
+HEADER_FORMAT = '<7sBQQQQQQQQQQQBBBBBBiiiiBii'
+
+
+def hilbert_xy_to_d(n: int, x: int, y: int) -> int:
+    # position of x, y on the hilbert curve filling an n * n grid
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    # tiles of all lower zooms come first, then the hilbert position within the zoom
+    return ((1 << (2 * z)) - 1) // 3 + hilbert_xy_to_d(1 << z, x, y)
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data: bytes, position: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def serialize_directory(entries: List[Tuple[int, int, int, int]]) -> bytes:
+    # entries are (tile_id, offset, length, run_length), a run length of 0 points to a leaf directory
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_id = 0
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buffer, tile_id - last_id)
+        last_id = tile_id
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buffer, run_length)
+    for tile_id, offset, length, run_length in entries:
+        write_varint(buffer, length)
+    for i, (tile_id, offset, length, run_length) in enumerate(entries):
+        # 0 means the entry follows the previous one directly
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, offset + 1)
+    return gzip.compress(bytes(buffer), mtime=0)
+
+
+def deserialize_directory(data: bytes) -> List[Tuple[int, int, int, int]]:
+    data = gzip.decompress(data)
+    count, position = read_varint(data, 0)
+    tile_ids = []
+    last_id = 0
+    for _ in range(count):
+        delta, position = read_varint(data, position)
+        last_id += delta
+        tile_ids.append(last_id)
+    run_lengths = []
+    for _ in range(count):
+        run_length, position = read_varint(data, position)
+        run_lengths.append(run_length)
+    lengths = []
+    for _ in range(count):
+        length, position = read_varint(data, position)
+        lengths.append(length)
+    entries = []
+    for i in range(count):
+        value, position = read_varint(data, position)
+        if value == 0 and i > 0:
+            offset = entries[i - 1][1] + entries[i - 1][2]
+        else:
+            offset = value - 1
+        entries.append((tile_ids[i], offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+def build_directories(entries: List[Tuple[int, int, int, int]]) -> Tuple[bytes, bytes]:
+    # (root directory, leaf directories), leaves are only used when the root does not fit
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_DIRECTORY_SIZE:
+        return root, b''
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start:start + leaf_size])
+            root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves.extend(leaf)
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_DIRECTORY_SIZE:
+            return root, bytes(leaves)
+        leaf_size = int(leaf_size * 1.2)
+
+
+def to_e7(value: float) -> int:
+    return int(round(value * 10000000))
+
+
+def serialize_header(header: Dict[str, Any]) -> bytes:
+    return struct.pack(
+        HEADER_FORMAT,
+        b'PMTiles', 3,
+        header['root_offset'], header['root_length'],
+        header['metadata_offset'], header['metadata_length'],
+        header['leaf_directory_offset'], header['leaf_directory_length'],
+        header['tile_data_offset'], header['tile_data_length'],
+        header['addressed_tiles_count'], header['tile_entries_count'], header['tile_contents_count'],
+        1, COMPRESSION_GZIP, header['tile_compression'], TILE_TYPE_MVT,
+        header['min_zoom'], header['max_zoom'],
+        to_e7(header['min_lon']), to_e7(header['min_lat']), to_e7(header['max_lon']), to_e7(header['max_lat']),
+        header['center_zoom'], to_e7(header['center_lon']), to_e7(header['center_lat']))
+
+
+def deserialize_header(data: bytes) -> Dict[str, Any]:
+    values = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    if values[0] != b'PMTiles' or values[1] != 3:
+        raise ValueError('not a PMTiles v3 archive')
+    names = ['root_offset', 'root_length', 'metadata_offset', 'metadata_length',
+             'leaf_directory_offset', 'leaf_directory_length', 'tile_data_offset', 'tile_data_length',
+             'addressed_tiles_count', 'tile_entries_count', 'tile_contents_count',
+             'clustered', 'internal_compression', 'tile_compression', 'tile_type', 'min_zoom', 'max_zoom']
+    return dict(zip(names, values[2:]))
+
+
+def export_mbtiles_to_pmtiles(db_file: str, pmtiles_path: str, tilejson: Any) -> int:
+    # tiles are laid out in tile id order, identical images are written once and runs of them share an entry
+    conn = sqlite3.connect(db_file)
+    try:
+        tiles = [
+            (zxy_to_tile_id(z, x, (1 << z) - 1 - tile_row), image_id)
+            for z, x, tile_row, image_id in conn.execute('SELECT zoom_level, tile_column, tile_row, tile_id FROM map;')
+        ]
+        tiles.sort()
+
+        entries = []
+        written = {}
+        data_file = tempfile.TemporaryFile(dir=os.path.dirname(pmtiles_path) or None)
+        data_length = 0
+        for tile_id, image_id in tiles:
+            location = written.get(image_id)
+            if location is None:
+                tile_data = conn.execute('SELECT tile_data FROM images WHERE tile_id = ?;', (image_id,)).fetchone()[0]
+                location = (data_length, len(tile_data))
+                data_file.write(tile_data)
+                data_length += len(tile_data)
+                written[image_id] = location
+            last = entries[-1] if len(entries) > 0 else None
+            if last is not None and last[1] == location[0] and last[0] + last[3] == tile_id:
+                entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                entries.append((tile_id, location[0], location[1], 1))
+    finally:
+        conn.close()
+
+    root, leaves = build_directories(entries)
+    metadata = {key: value for key, value in tilejson.items() if key not in ['tiles', 'scheme', 'tilejson']}
+    metadata = gzip.compress(json.dumps(metadata).encode(), mtime=0)
+    bounds = tilejson.get('bounds') or [-180, -85.0511287798066, 180, 85.0511287798066]
+    center = tilejson.get('center') or [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, tilejson['minzoom']]
+    header = {
+        'root_offset': HEADER_SIZE,
+        'root_length': len(root),
+        'metadata_offset': HEADER_SIZE + len(root),
+        'metadata_length': len(metadata),
+        'leaf_directory_offset': HEADER_SIZE + len(root) + len(metadata),
+        'leaf_directory_length': len(leaves),
+        'tile_data_offset': HEADER_SIZE + len(root) + len(metadata) + len(leaves),
+        'tile_data_length': data_length,
+        'addressed_tiles_count': len(tiles),
+        'tile_entries_count': len(entries),
+        'tile_contents_count': len(written),
+        'tile_compression': COMPRESSION_GZIP,
+        'min_zoom': tilejson['minzoom'],
+        'max_zoom': tilejson['maxzoom'],
+        'min_lon': bounds[0], 'min_lat': bounds[1], 'max_lon': bounds[2], 'max_lat': bounds[3],
+        'center_zoom': int(center[2]), 'center_lon': center[0], 'center_lat': center[1]
+    }
+
+    # written next to the final file and renamed, readers never see a partial archive
+    tmp_path = f'{pmtiles_path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as archive:
+            archive.write(serialize_header(header))
+            archive.write(root)
+            archive.write(metadata)
+            archive.write(leaves)
+            data_file.seek(0)
+            shutil.copyfileobj(data_file, archive)
+    finally:
+        data_file.close()
+    os.replace(tmp_path, pmtiles_path)
+    return len(tiles)
+
+
+class PMTilesReader:
+    """Tile lookups in a memory mapped PMTiles archive"""
+
+    def __init__(self, pmtiles_path: str):
+        self.pmtiles_path = pmtiles_path
+        self.file = open(pmtiles_path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = deserialize_header(self.data[:HEADER_SIZE])
+        self.root = self._read_directory(self.header['root_offset'], self.header['root_length'])
+        # decoded leaf directories by offset, an archive has few of them
+        self.leaves = {}
+
+    def _read_directory(self, offset: int, length: int):
+        entries = deserialize_directory(self.data[offset:offset + length])
+        return [entry[0] for entry in entries], entries
+
+    def _find_entry(self, directory, tile_id: int):
+        tile_ids, entries = directory
+        i = bisect.bisect_right(tile_ids, tile_id) - 1
+        if i < 0:
+            return None
+        return entries[i]
+
+    def read_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        tile_id = zxy_to_tile_id(z, x, y)
+        directory = self.root
+        # root -> leaf -> tile, the spec allows at most a few levels
+        for _ in range(4):
+            entry = self._find_entry(directory, tile_id)
+            if entry is None:
+                return None
+            entry_tile_id, offset, length, run_length = entry
+            if run_length == 0:
+                leaf = self.leaves.get(offset)
+                if leaf is None:
+                    leaf = self._read_directory(self.header['leaf_directory_offset'] + offset, length)
+                    self.leaves[offset] = leaf
+                directory = leaf
+                continue
+            if tile_id >= entry_tile_id + run_length:
+                return None
+            start = self.header['tile_data_offset'] + offset
+            return self.data[start:start + length]
+        return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
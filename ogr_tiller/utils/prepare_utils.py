@@ -0,0 +1,260 @@
+import glob
+import json
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional
+import fiona
+import numpy as np
+import shapely
+from shapely.geometry import mapping, shape
+from shapely.ops import polylabel
+from ogr_tiller.poco.tileset_manifest import TilesetManifest
+from ogr_tiller.utils.ogr_utils import get_tileset_manifest
+from ogr_tiller.utils.proj_utils import transform_coords
+from rich import print
+
+WORLD_EXTENT = 20037508.342789244
+# zooms between two level of detail copies
+LOD_ZOOM_STEP = 2
+# finer levels are not written once a level keeps this share of the vertices
+LOD_MAX_VERTEX_RATIO = 0.8
+# precision of polylabel label points in meters
+POLYLABEL_TOLERANCE = 1.0
+# metadata namespace of the copies, holds the manifest settings a copy was written with
+TAGS_NS = 'ogr_tiller'
+
+
+def get_prepared_folder(cache_folder: str) -> str:
+    return os.path.join(cache_folder, 'prepared')
+
+
+def get_prepared_path(cache_folder: str, tileset: str) -> str:
+    return os.path.join(get_prepared_folder(cache_folder), f'{tileset}.gpkg')
+
+
+def get_lod_path(cache_folder: str, tileset: str, zoom: int) -> str:
+    return os.path.join(get_prepared_folder(cache_folder), f'{tileset}.lod{zoom}.gpkg')
+
+
+def get_lod_paths(cache_folder: str, tileset: str) -> Dict[int, str]:
+    # level of detail copies of a tileset by zoom
+    result = {}
+    prefix = os.path.join(get_prepared_folder(cache_folder), f'{tileset}.lod')
+    for lod_path in glob.glob(f'{glob.escape(prefix)}*.gpkg'):
+        zoom = lod_path[len(prefix):-len('.gpkg')]
+        if zoom.isdigit():
+            result[int(zoom)] = lod_path
+    return result
+
+
+def zoom_tolerance(zoom: int, extent: int, simplify_tolerance: float) -> float:
+    # simplify tolerance of the tiles of a zoom, same as unit_pixel_distance * simplify_tolerance in tile_utils
+    return 2 * WORLD_EXTENT / (2 ** zoom) / extent * simplify_tolerance
+
+
+def get_prepare_options(use_polylabel: bool) -> str:
+    # manifest settings the prepared copy depends on
+    return json.dumps({'polylabel': use_polylabel}, sort_keys=True)
+
+
+def get_lod_options(manifest: TilesetManifest) -> str:
+    # manifest settings the level of detail copies depend on, they pick the zooms and tolerances
+    return json.dumps({
+        'minzoom': manifest.minzoom,
+        'maxzoom': manifest.maxzoom,
+        'extent': manifest.extent,
+        'simplify_tolerance': manifest.simplify_tolerance
+    }, sort_keys=True)
+
+
+@lru_cache(maxsize=256)
+def read_copy_options(prepared_path: str, mtime: float) -> Optional[str]:
+    # settings stored in a copy by write_layer, mtime invalidates the entry
+    try:
+        with fiona.open(prepared_path, 'r', layer=fiona.listlayers(prepared_path)[0]) as layer:
+            return layer.tags(ns=TAGS_NS).get('options')
+    except Exception as e:
+        print(f'error reading {prepared_path}', e)
+        return None
+
+
+def is_prepared_fresh(ds_path: str, prepared_path: str, options: str) -> bool:
+    # a copy is only used while it is newer than its source and was written with the current settings
+    if prepared_path is None or not os.path.isfile(prepared_path):
+        return False
+    mtime = os.path.getmtime(prepared_path)
+    if mtime < os.path.getmtime(ds_path):
+        return False
+    return read_copy_options(prepared_path, mtime) == options
+
+
+def get_source_path(ds_path: str, prepared_path: str, manifest: TilesetManifest) -> str:
+    if prepared_path is not None and is_prepared_fresh(ds_path, prepared_path, get_prepare_options(manifest.polylabel)):
+        return prepared_path
+    return ds_path
+
+
+def to_web_mercator(srid, geometries: np.ndarray) -> np.ndarray:
+    if srid == 'EPSG:3857':
+        return geometries
+
+    def reproject(coords):
+        # points beyond the web mercator latitude limits end up on the edge of the world
+        return np.clip(transform_coords(srid, 'EPSG:3857', coords), -WORLD_EXTENT, WORLD_EXTENT)
+
+    return shapely.transform(geometries, reproject)
+
+
+def read_layer(ds_path: str, layer_name: str):
+    # (crs, schema, geometries, properties) of every feature of a layer
+    with fiona.open(ds_path, 'r', layer=layer_name) as layer:
+        srid = layer.crs
+        schema = layer.schema.copy()
+        properties = []
+        geometries = []
+        for feat in layer:
+            properties.append(dict(feat.properties))
+            geometries.append(shape(feat.geometry) if feat.geometry is not None else None)
+
+    geometries_array = np.empty(len(geometries), dtype=object)
+    geometries_array[:] = geometries
+    return srid, schema, geometries_array, properties
+
+
+def write_layer(prepared_path: str, layer_name: str, schema, geometries: np.ndarray, properties: List[dict],
+                options: str, geometry_type: str = 'Unknown'):
+    # make_valid can turn a polygon into a collection, so the layer accepts any geometry type
+    schema['geometry'] = geometry_type
+    with fiona.open(prepared_path, 'w', driver='GPKG', schema=schema, crs='EPSG:3857',
+                    layer=layer_name, SPATIAL_INDEX='YES') as prepared_layer:
+        prepared_layer.writerecords(
+            fiona.Feature.from_dict({
+                'geometry': mapping(geometry) if geometry is not None else None,
+                'properties': feat_properties
+            })
+            for geometry, feat_properties in zip(geometries, properties)
+        )
+        prepared_layer.update_tags({'options': options}, ns=TAGS_NS)
+
+
+def make_valid(geometries: np.ndarray) -> np.ndarray:
+    # make_valid turns a polygon with a spike into a collection with the spike as a line,
+    # and a collapsed polygon into lines. only the parts with the dimension of the source
+    # geometry are kept, features without any are left without a geometry.
+    dimensions = shapely.get_dimensions(geometries)
+    valid = shapely.make_valid(geometries)
+    changed = (shapely.get_type_id(valid) == 7) | (shapely.get_dimensions(valid) != dimensions)
+    for i in np.flatnonzero(changed & (shapely.get_type_id(geometries) != 7)):
+        parts = [part for part in shapely.get_parts(valid[i]) if shapely.get_dimensions(part) == dimensions[i]]
+        if len(parts) == 0:
+            valid[i] = None
+        elif len(parts) == 1:
+            valid[i] = parts[0]
+        else:
+            valid[i] = [shapely.multipoints, shapely.multilinestrings, shapely.multipolygons][dimensions[i]](parts)
+    return valid
+
+
+def label_points(polygons: np.ndarray, use_polylabel: bool) -> np.ndarray:
+    if not use_polylabel:
+        return shapely.point_on_surface(polygons)
+
+    def largest_part(polygon):
+        if polygon.geom_type == 'MultiPolygon':
+            return max(polygon.geoms, key=lambda part: part.area)
+        return polygon
+
+    # pole of inaccessibility, the point farthest from the edges of the largest part
+    points = np.empty(len(polygons), dtype=object)
+    points[:] = [polylabel(largest_part(polygon), tolerance=POLYLABEL_TOLERANCE) for polygon in polygons]
+    return points
+
+
+def prepare_layer(ds_path: str, prepared_path: str, layer_name: str, use_polylabel: bool = False):
+    options = get_prepare_options(use_polylabel)
+    srid, schema, geometries, properties = read_layer(ds_path, layer_name)
+    geometries = make_valid(to_web_mercator(srid, geometries))
+    write_layer(prepared_path, layer_name, schema, geometries, properties, options)
+
+    # label points of the polygons are computed once here instead of for every tile,
+    # empty polygons have no label point
+    polygons = np.flatnonzero(np.isin(shapely.get_type_id(geometries), [3, 6]) & ~shapely.is_empty(geometries))
+    if len(polygons) > 0:
+        write_layer(prepared_path, f'{layer_name}_label', schema, label_points(geometries[polygons], use_polylabel),
+                    [properties[i] for i in polygons], options, geometry_type='Point')
+
+
+def get_tmp_path(prepared_path: str) -> str:
+    return f'{prepared_path[:-len(".gpkg")]}.tmp.gpkg'
+
+
+def prepare_tileset(ds_path: str, prepared_path: str, use_polylabel: bool = False):
+    # written next to the final file and renamed, readers never see a partial copy
+    tmp_path = get_tmp_path(prepared_path)
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    for layer_name in fiona.listlayers(ds_path):
+        prepare_layer(ds_path, tmp_path, layer_name, use_polylabel)
+    os.replace(tmp_path, prepared_path)
+
+
+def remove_lod(cache_folder: str, tileset: str):
+    for lod_path in get_lod_paths(cache_folder, tileset).values():
+        os.remove(lod_path)
+
+
+def is_lod_fresh(cache_folder: str, tileset: str, prepared_path: str, manifest: TilesetManifest) -> bool:
+    options = get_lod_options(manifest)
+    lod_paths = get_lod_paths(cache_folder, tileset).values()
+    return len(lod_paths) > 0 and all(is_prepared_fresh(prepared_path, lod_path, options) for lod_path in lod_paths)
+
+
+def prepare_lod(cache_folder: str, tileset: str, prepared_path: str, manifest: TilesetManifest):
+    # copies of the prepared dataset simplified for the coarsest zoom of a band of zooms,
+    # with the same tolerance the tiles of that zoom are simplified with. features which
+    # collapse at that tolerance are left out.
+    remove_lod(cache_folder, tileset)
+    options = get_lod_options(manifest)
+    layers = [(layer_name, *read_layer(prepared_path, layer_name)[1:]) for layer_name in fiona.listlayers(prepared_path)]
+    vertex_count = sum(int(shapely.get_num_coordinates(geometries).sum()) for _, _, geometries, _ in layers)
+    for zoom in range(manifest.minzoom, manifest.maxzoom, LOD_ZOOM_STEP):
+        tolerance = zoom_tolerance(zoom, manifest.extent, manifest.simplify_tolerance)
+        level = []
+        for layer_name, schema, geometries, properties in layers:
+            simplified = shapely.simplify(geometries, tolerance, preserve_topology=False)
+            keep = ~shapely.is_missing(simplified) & ~shapely.is_empty(simplified)
+            level.append((layer_name, schema, simplified[keep], [properties[i] for i in np.flatnonzero(keep)]))
+        level_vertex_count = sum(int(shapely.get_num_coordinates(geometries).sum()) for _, _, geometries, _ in level)
+        if level_vertex_count > vertex_count * LOD_MAX_VERTEX_RATIO:
+            break
+
+        lod_path = get_lod_path(cache_folder, tileset, zoom)
+        tmp_path = get_tmp_path(lod_path)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        for layer_name, schema, geometries, properties in level:
+            write_layer(tmp_path, layer_name, schema.copy(), geometries, properties, options)
+        os.replace(tmp_path, lod_path)
+        print(f'{tileset} level of detail for zoom {zoom}: {level_vertex_count} of {vertex_count} vertices')
+
+
+def prepare_sources(data_folder: str, cache_folder: str, tilesets: List[str], force: bool = False):
+    os.makedirs(get_prepared_folder(cache_folder), exist_ok=True)
+    for tileset in tilesets:
+        ds_path = os.path.join(data_folder, f'{tileset}.gpkg')
+        prepared_path = get_prepared_path(cache_folder, tileset)
+        manifest: TilesetManifest = get_tileset_manifest()[tileset]
+        try:
+            if not force and is_prepared_fresh(ds_path, prepared_path, get_prepare_options(manifest.polylabel)):
+                print(f'{tileset} prepared copy is up to date')
+            else:
+                print(f'preparing {tileset}')
+                prepare_tileset(ds_path, prepared_path, manifest.polylabel)
+
+            if not manifest.lod:
+                remove_lod(cache_folder, tileset)
+            elif force or not is_lod_fresh(cache_folder, tileset, prepared_path, manifest):
+                print(f'preparing {tileset} levels of detail')
+                prepare_lod(cache_folder, tileset, prepared_path, manifest)
+        except Exception as e:
+            print(f'error preparing {tileset}', e)
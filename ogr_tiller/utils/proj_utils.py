@@ -1,7 +1,49 @@
+import threading
+import numpy as np
 from pyproj import Transformer
 
+# points per bbox edge, the edges of a reprojected bbox are curves
+DENSIFY_POINTS = 21
+
+# pyproj transformers are not thread safe, every thread keeps its own
+transformer_cache = threading.local()
+
+
+def get_transformer(from_crs, to_crs) -> Transformer:
+    transformers = getattr(transformer_cache, 'transformers', None)
+    if transformers is None:
+        transformers = transformer_cache.transformers = {}
+    key = (str(from_crs), str(to_crs))
+    transformer = transformers.get(key)
+    if transformer is None:
+        transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
+        transformers[key] = transformer
+    return transformer
+
+
+def transform_coords(from_crs, to_crs, coords: np.ndarray) -> np.ndarray:
+    # coords is an (n, 2) array, reprojected in one call
+    coords = np.asarray(coords, dtype=float)
+    x, y = get_transformer(from_crs, to_crs).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def get_bboxes_for_crs(from_crs, to_crs, bboxes: np.ndarray) -> np.ndarray:
+    # bboxes is an (n, 4) array of (xmin, ymin, xmax, ymax), every edge is densified
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    steps = np.linspace(0, 1, DENSIFY_POINTS)
+    xmin, ymin, xmax, ymax = [bboxes[:, i:i + 1] for i in range(4)]
+    xs = xmin + (xmax - xmin) * steps
+    ys = ymin + (ymax - ymin) * steps
+    edge_x = np.concatenate([xs, xs, np.broadcast_to(xmin, xs.shape), np.broadcast_to(xmax, xs.shape)], axis=1)
+    edge_y = np.concatenate([np.broadcast_to(ymin, ys.shape), np.broadcast_to(ymax, ys.shape), ys, ys], axis=1)
+
+    x, y = get_transformer(from_crs, to_crs).transform(edge_x.ravel(), edge_y.ravel())
+    x = np.asarray(x).reshape(edge_x.shape)
+    y = np.asarray(y).reshape(edge_y.shape)
+    return np.column_stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)])
+
+
 def get_bbox_for_crs(from_crs, to_crs, bbox):
-    transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
-    xmin, ymin = transformer.transform(bbox[0], bbox[1])
-    xmax, ymax = transformer.transform(bbox[2], bbox[3])
-    return (xmin, ymin, xmax, ymax)
\ No newline at end of file
+    xmin, ymin, xmax, ymax = get_bboxes_for_crs(from_crs, to_crs, [bbox])[0]
+    return (float(xmin), float(ymin), float(xmax), float(ymax))
@@ -0,0 +1,34 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result"""
+
+    def __init__(self):
+        self.in_flight: Dict[Any, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def run(self, key: Any, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done_task: self._done(key, done_task))
+        else:
+            self.coalesced += 1
+        # a caller going away (client disconnect) must not cancel the work the others wait for
+        return await asyncio.shield(task)
+
+    def _done(self, key: Any, task: asyncio.Task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # mark the exception as retrieved when every caller has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Any:
+        return {
+            'in_flight': len(self.in_flight),
+            'coalesced': self.coalesced
+        }
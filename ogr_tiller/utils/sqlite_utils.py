@@ -1,7 +1,10 @@
+import atexit
+import hashlib
 import sqlite3
+import threading
 from sqlite3 import Error
 import os
-from typing import Any, List
+from typing import Any, List, Optional, Tuple
 import glob 
 from rich import print
 import json
@@ -10,63 +13,279 @@ from ogr_tiller.poco.tileset_manifest import TilesetManifest
 # setup tile cache
 cache_location = None
 tileset_db_files = {}
+tileset_connections = {}
+
+# mbtiles layout: tiles are addressed in the TMS scheme (tile_row counted from the bottom)
+# and identical tile blobs are stored once in images, referenced from map by their hash
+CREATE_TILE_TABLES_SQL = [
+    '''
+    CREATE TABLE map (
+        zoom_level INTEGER NOT NULL,
+        tile_column INTEGER NOT NULL,
+        tile_row INTEGER NOT NULL,
+        tile_id TEXT NOT NULL,
+        PRIMARY KEY (zoom_level, tile_column, tile_row)
+    ) WITHOUT ROWID;
+    ''',
+    'CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB);',
+    '''
+    CREATE VIEW tiles AS
+        SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+               map.tile_row AS tile_row, images.tile_data AS tile_data
+        FROM map JOIN images ON images.tile_id = map.tile_id;
+    '''
+]
+INSERT_IMAGE_SQL = 'INSERT OR IGNORE INTO images(tile_id,tile_data) VALUES(?,?);'
+INSERT_MAP_SQL = 'INSERT OR REPLACE INTO map(zoom_level,tile_column,tile_row,tile_id) VALUES(?,?,?,?);'
+READ_TILE_SQL = '''
+SELECT images.tile_data, images.tile_id FROM map JOIN images ON images.tile_id = map.tile_id
+WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?
+'''
+# plain tiles tables: the cache layout of older versions, with x in tile_row and y in
+# tile_column, and mbtiles files written by other tools which are only ever read
+LEGACY_TILES_COLUMNS = {'tile_row': 1, 'tile_column': 2, 'zoom_level': 3, 'tile_data': 0}
+READ_LEGACY_TILE_SQL = 'SELECT tile_data FROM tiles WHERE tile_row = ? AND tile_column = ? AND zoom_level = ?;'
+READ_PLAIN_TILE_SQL = 'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;'
+MIGRATE_LEGACY_TILES_SQL = [
+    'ALTER TABLE tiles RENAME TO legacy_tiles;',
+    *CREATE_TILE_TABLES_SQL,
+    'INSERT OR IGNORE INTO images(tile_id,tile_data) SELECT tile_hash(tile_data), tile_data FROM legacy_tiles WHERE tile_data IS NOT NULL;',
+    '''
+    INSERT OR REPLACE INTO map(zoom_level,tile_column,tile_row,tile_id)
+        SELECT zoom_level, tile_row, (1 << zoom_level) - 1 - tile_column, tile_hash(tile_data)
+        FROM legacy_tiles WHERE tile_data IS NOT NULL;
+    ''',
+    'DROP TABLE legacy_tiles;',
+    "DELETE FROM metadata WHERE name = 'scheme';"
+]
+PRUNE_IMAGES_SQL = 'DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);'
+# quadtree subtrees finished by build_cache, used to resume an interrupted build
+CHECKPOINT_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS build_checkpoints (
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    z INTEGER NOT NULL,
+    max_zoom INTEGER NOT NULL,
+    PRIMARY KEY (x, y, z, max_zoom)
+);
+'''
+
+
+def tile_hash(tile_data: bytes) -> str:
+    return hashlib.md5(tile_data).hexdigest()
+
+
+def tms_row(y: int, z: int) -> int:
+    return (1 << z) - 1 - y
+
+
+def write_tile_rows(conn: sqlite3.Connection, rows: List[Tuple[int, int, int, bytes, str]]):
+    # [(x, y, z, tile_data, tile_id)], caller manages the transaction
+    conn.executemany(INSERT_IMAGE_SQL, [(tile_id, tile_data) for x, y, z, tile_data, tile_id in rows])
+    conn.executemany(INSERT_MAP_SQL, [(z, x, tms_row(y, z), tile_id) for x, y, z, tile_data, tile_id in rows])
+
+
+class MBTilesConnectionManager:
+    """Long lived connections to one mbtiles file: a reader per thread and a single batching writer"""
+
+    def __init__(self, db_file: str, batch_size: int = 256, flush_interval: float = 1.0, mmap_size: int = 256 * 1024 * 1024,
+                 layout: str = 'spec', read_only: bool = False):
+        self.db_file = db_file
+        # spec, legacy or tiles, see get_mbtiles_layout
+        self.layout = layout
+        # files served with serve_cache are opened read only and never changed
+        self.read_only = read_only
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        # (tile_data, tile_id) waiting to be written, keyed by (x, y, z) so reads see them before the commit
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            conn = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)};')
+        conn.execute('PRAGMA busy_timeout=5000;')
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    def read_tile(self, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+        # (tile_data, tile_id), the tile id is the hash of the tile data
+        with self.pending_lock:
+            pending_tile = self.pending.get((x, y, z))
+        if pending_tile is not None:
+            return pending_tile
+        # sqlite keeps the prepared statement in the connection statement cache
+        if self.layout == 'spec':
+            record = self.reader().execute(READ_TILE_SQL, (z, x, tms_row(y, z))).fetchone()
+            if record is None:
+                return None
+            return record[0], record[1]
+        if self.layout == 'legacy':
+            record = self.reader().execute(READ_LEGACY_TILE_SQL, (x, y, z)).fetchone()
+        else:
+            record = self.reader().execute(READ_PLAIN_TILE_SQL, (z, x, tms_row(y, z))).fetchone()
+        if record is None or record[0] is None:
+            return None
+        return record[0], tile_hash(record[0])
+
+    def write_tile(self, x: int, y: int, z: int, tile_data: Any):
+        self.write_tiles([(x, y, z, tile_data)])
+
+    def write_tiles(self, rows: List[Any]):
+        with self.pending_lock:
+            for x, y, z, tile_data in rows:
+                self.pending[(x, y, z)] = (tile_data, tile_hash(tile_data))
+            should_flush = len(self.pending) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self.writer_lock:
+            with self.pending_lock:
+                pending = list(self.pending.items())
+            if len(pending) == 0:
+                return
+            if self.writer is None:
+                self.writer = self._connect()
+            with self.writer:
+                write_tile_rows(self.writer, [(x, y, z, tile_data, tile_id) for (x, y, z), (tile_data, tile_id) in pending])
+            with self.pending_lock:
+                for key, pending_tile in pending:
+                    if self.pending.get(key) is pending_tile:
+                        del self.pending[key]
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Error as e:
+                print(e)
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            self.flush()
+        except Error as e:
+            print(e)
+        with self.writer_lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+
+
+def get_connection_manager(tileset: str) -> MBTilesConnectionManager:
+    return tileset_connections[tileset]
+
+
+def close_connection_managers():
+    for manager in tileset_connections.values():
+        manager.close()
+
+
+atexit.register(close_connection_managers)
 
 
 def update_cache(tileset: str, x: int, y: int, z: int, tile_data: Any):  
-    conn = None
     try:
-        conn = sqlite3.connect(tileset_db_files[tileset])
-        sql = '''
-        INSERT INTO tiles(tile_row,tile_column,zoom_level,tile_data)
-              VALUES(?,?,?,?) 
-        '''
-        conn.execute(sql, (x, y, z, tile_data))
-        conn.commit()
+        get_connection_manager(tileset).write_tile(x, y, z, tile_data)
     except Error as e:
         print(e)
-    finally:
-        if conn:
-            conn.close()
 
-def update_multiple_cache(tileset: str, rows: List[Any]):  
-    # [(tileset, x, y, z, tile_data)]
-    conn = None
+
+def read_cache(tileset: str, x: int, y: int, z: int) -> Optional[Tuple[bytes, str]]:
+    # (tile_data, tile_id) or None
+    manager = tileset_connections.get(tileset)
+    if manager is None:
+        return None
     try:
-        conn = sqlite3.connect(tileset_db_files[tileset])
-        sql = '''
-        INSERT INTO tiles(tile_row,tile_column,zoom_level,tile_data)
-              VALUES(?,?,?,?) 
-        '''
-        conn.executemany(sql, rows)
-        conn.commit()
-    except Error as e:
-        print(e)
-    finally:
-        if conn:
-            conn.close()
+        return manager.read_tile(x, y, z)
+    except sqlite3.Error as error:
+        print("Failed to read tile_data from sqlite table", error)
 
 
-def read_cache(tileset: str, x: int, y: int, z: int):
-    try:
-        conn = sqlite3.connect(tileset_db_files[tileset])
-        cursor = conn.cursor()
+class TileBatchWriter:
+    """Streams generated tiles into an mbtiles file, committing every few tiles or megabytes"""
 
-        sql = """SELECT tile_data from tiles where tile_row = ? and tile_column = ? and zoom_level = ? """
-        cursor.execute(sql, (x, y, z))
-        record = cursor.fetchone()
-        result = None
-        if record is None:
-            result = None
-        else:
-            result = record[0]
-        cursor.close()
-        return result
+    def __init__(self, db_file: str, max_tiles: int = 500, max_bytes: int = 32 * 1024 * 1024):
+        self.max_tiles = max_tiles
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.size = 0
+        self.count = 0
+        # tiles which failed to generate, a subtree with failures is not checkpointed
+        self.errors = 0
+        # several build workers may write the same file, wait for the lock instead of failing
+        self.conn = sqlite3.connect(db_file, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
 
-    except sqlite3.Error as error:
-        print("Failed to read tile_data from sqlite table", error)
-    finally:
-        if conn:
-            conn.close()
+    def add(self, x: int, y: int, z: int, tile_data: Any):
+        self.rows.append((x, y, z, tile_data, tile_hash(tile_data)))
+        self.size += len(tile_data)
+        self.count += 1
+        if len(self.rows) >= self.max_tiles or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        with self.conn:
+            write_tile_rows(self.conn, self.rows)
+        self.rows = []
+        self.size = 0
+
+    def checkpoint(self, x: int, y: int, z: int, max_zoom: int):
+        # remaining tiles and the checkpoint are committed together
+        with self.conn:
+            self.conn.execute(CHECKPOINT_TABLE_SQL)
+            write_tile_rows(self.conn, self.rows)
+            self.conn.execute('INSERT OR REPLACE INTO build_checkpoints(x,y,z,max_zoom) VALUES(?,?,?,?);', (x, y, z, max_zoom))
+        self.rows = []
+        self.size = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_mbtile_path(cache_folder: str, tileset: str) -> str:
+    return os.path.join(cache_folder, f'{tileset}.mbtiles')
 
 
 def cleanup_mbtile_cache(cache_folder):
@@ -77,7 +296,18 @@ def cleanup_mbtile_cache(cache_folder):
             os.remove(file)
 
 
-def setup_mbtile_cache(tileset: str, cache_folder: str, tilejson: any):
+def cleanup_orphan_mbtile_cache(cache_folder: str, tilesets: List[str]):
+    # cache files of tilesets which are no longer in the data folder
+    files = []
+    for pattern in ['*.mbtiles*', '*.pmtiles*']:
+        files.extend(glob.glob(os.path.join(cache_folder, pattern), recursive=False))
+    for file in files:
+        tileset = os.path.basename(file).split('.')[0]
+        if os.path.isfile(file) and tileset not in tilesets:
+            os.remove(file)
+
+
+def setup_mbtile_cache(tileset: str, cache_folder: str, tilejson: any, read_only: bool = False):
     global cache_location, tileset_db_files
 
     def process_value(key, val):
@@ -97,26 +327,42 @@ def setup_mbtile_cache(tileset: str, cache_folder: str, tilejson: any):
 
     # update global variablea
     cache_location = cache_folder
-    tileset_db_files[tileset] = os.path.join(cache_location, f'{tileset}.mbtiles')
+    tileset_db_files[tileset] = get_mbtile_path(cache_location, tileset)
 
-    if os.path.isfile(tileset_db_files[tileset]):
-        return
+    if tileset in tileset_connections:
+        tileset_connections.pop(tileset).close()
+
+    db_file = tileset_db_files[tileset]
+    if os.path.isfile(db_file):
+        try:
+            layout = get_mbtiles_layout(db_file)
+        except Error as e:
+            raise ValueError(f'{tileset}: {db_file} can not be read as an mbtiles file: {e}')
+        if layout == 'legacy' and not read_only:
+            # caches of older versions keep x in tile_row and cannot be read by other tools
+            print(f'{tileset}: migrating cache with the old mbtiles layout')
+            migrate_legacy_mbtiles(db_file)
+            layout = 'spec'
+        if layout is None and read_only:
+            print(f'[red]{tileset}: {db_file} has no tiles table, no tiles are served from it[/red]')
+            return
+        if layout is not None:
+            if layout != 'spec' and not read_only:
+                raise ValueError(f'{tileset}: {db_file} was not written by ogr_tiller, serve it with --mode serve_cache or move it away')
+            tileset_connections[tileset] = MBTilesConnectionManager(db_file, layout=layout, read_only=read_only)
+            return
 
     conn = None
     try:
         conn = sqlite3.connect(tileset_db_files[tileset])
-        conn.execute('''
-        CREATE TABLE tiles (
-            tile_row INTEGER NOT NULL,
-            tile_column INTEGER NOT NULL,
-            zoom_level INTEGER NOT NULL,
-            tile_data BLOB,
-            PRIMARY KEY (tile_row, tile_column, zoom_level)
-        );
-        ''')
+        for sql in CREATE_TILE_TABLES_SQL:
+            conn.execute(sql)
         conn.execute('CREATE TABLE metadata (name text, value text);')
         conn.commit()
-        manifest_rows = [ process_value(k, v) for k, v in tilejson.items()]
+        # stored tiles use the TMS scheme, the xyz scheme of the served tilejson does not apply
+        manifest_rows = [ process_value(k, v) for k, v in tilejson.items() if k != 'scheme']
+        # pbf tiles are stored gzip compressed
+        manifest_rows.append(['compression', 'gzip'])
         conn.executemany('INSERT INTO metadata(name,value) VALUES(?,?);', manifest_rows)
         conn.commit()
     except Error as e:
@@ -125,5 +371,113 @@ def setup_mbtile_cache(tileset: str, cache_folder: str, tilejson: any):
         if conn:
             conn.close()
 
-def update_metadata():
-    pass
\ No newline at end of file
+    tileset_connections[tileset] = MBTilesConnectionManager(tileset_db_files[tileset])
+
+def get_mbtiles_layout(db_file: str) -> Optional[str]:
+    # spec: map and images tables behind a tiles view, written by this version
+    # legacy: the tiles table of older versions, which kept x in tile_row
+    # tiles: any other tiles table, like the mbtiles files of other tools
+    # None: no tiles yet
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    try:
+        objects = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE name IN ('tiles', 'map', 'images');").fetchall())
+        if objects.get('tiles') is None:
+            return None
+        if objects.get('tiles') == 'view' and objects.get('map') == 'table' and objects.get('images') == 'table':
+            return 'spec'
+        if 'map' in objects or 'images' in objects or objects['tiles'] != 'table':
+            return 'tiles'
+        columns = {name: pk for cid, name, type, notnull, default, pk in conn.execute('PRAGMA table_info(tiles);')}
+        return 'legacy' if columns == LEGACY_TILES_COLUMNS else 'tiles'
+    finally:
+        conn.close()
+
+
+def migrate_legacy_mbtiles(db_file: str):
+    # rewrites the tiles of the old layout into map and images in one transaction,
+    # the file is left as it was when anything fails
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        conn.create_function('tile_hash', 1, tile_hash, deterministic=True)
+        conn.execute('BEGIN;')
+        try:
+            for sql in MIGRATE_LEGACY_TILES_SQL:
+                conn.execute(sql)
+            conn.execute('COMMIT;')
+        except Error as e:
+            conn.execute('ROLLBACK;')
+            raise ValueError(f'{db_file} could not be migrated to the mbtiles layout and was left unchanged: {e}')
+    finally:
+        conn.close()
+
+
+def prune_images(tileset: str):
+    # images no longer referenced by any tile, left behind when tiles are replaced
+    conn = None
+    try:
+        conn = sqlite3.connect(tileset_db_files[tileset], timeout=60)
+        with conn:
+            conn.execute(PRUNE_IMAGES_SQL)
+    except Error as e:
+        print(e)
+    finally:
+        if conn:
+            conn.close()
+
+
+def get_built_subtrees(tileset: str):
+    conn = None
+    try:
+        conn = sqlite3.connect(tileset_db_files[tileset])
+        conn.execute(CHECKPOINT_TABLE_SQL)
+        return set(conn.execute('SELECT x, y, z, max_zoom FROM build_checkpoints;').fetchall())
+    except Error as e:
+        print(e)
+        return set()
+    finally:
+        if conn:
+            conn.close()
+
+
+def read_metadata(tileset: str, name: str):
+    conn = None
+    try:
+        conn = sqlite3.connect(tileset_db_files[tileset])
+        record = conn.execute('SELECT value FROM metadata WHERE name = ?;', (name,)).fetchone()
+        if record is None:
+            return None
+        return record[0]
+    except Error as e:
+        print(e)
+    finally:
+        if conn:
+            conn.close()
+
+
+def update_metadata(tileset: str, name: str, value: str):
+    conn = None
+    try:
+        conn = sqlite3.connect(tileset_db_files[tileset])
+        with conn:
+            conn.execute('DELETE FROM metadata WHERE name = ?;', (name,))
+            conn.execute('INSERT INTO metadata(name,value) VALUES(?,?);', (name, value))
+    except Error as e:
+        print(e)
+    finally:
+        if conn:
+            conn.close()
+
+
+def remove_mbtile_cache(tileset: str):
+    if tileset in tileset_connections:
+        tileset_connections.pop(tileset).close()
+    db_file = tileset_db_files.get(tileset)
+    if db_file is None:
+        return
+    remove_mbtile_files(db_file)
+
+
+def remove_mbtile_files(db_file: str):
+    for file in [db_file, f'{db_file}-wal', f'{db_file}-shm']:
+        if os.path.isfile(file):
+            os.remove(file)
\ No newline at end of file
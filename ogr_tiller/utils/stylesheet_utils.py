@@ -1,9 +1,8 @@
 import random
-from typing import Any, List
-import fiona
-import os
+from typing import Any, List, Tuple
 
-def get_starter_style(port: str, cached_tileset_names: List[str], data_location: str) -> Any:
+def get_starter_style(port: str, cached_tileset_names: List[str], layer_geometry_types: List[Tuple[str, str, str]]) -> Any:
+    # layer_geometry_types is [(tileset, layer_name, geometry_type)]
     style_json = {
         'version': 8,
         'sources': {},
@@ -16,15 +15,6 @@ def get_starter_style(port: str, cached_tileset_names: List[str], data_location:
             'url': f'http://0.0.0.0:{port}/tilesets/{tileset}/info/tile.json'
         }
 
-    layer_geometry_types = []
-    for tileset in cached_tileset_names:
-        ds_path = os.path.join(data_location, f'{tileset}.gpkg')
-        layers = fiona.listlayers(ds_path)
-        for layer_name in layers:
-            with fiona.open(ds_path, 'r', layer=layer_name) as layer:
-                layer_geometry_types.append(
-                    (tileset, layer_name, layer.schema['geometry']))
-
     geometry_order = [
         'Point',
         '3D Point',
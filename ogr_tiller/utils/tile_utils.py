@@ -1,14 +1,19 @@
-from typing import Any, List, Tuple
+from typing import List
+import gzip
 import mapbox_vector_tile
-from ogr_tiller.utils import tile_utils
+from ogr_tiller.utils import arrow_utils, tile_utils
+from ogr_tiller.poco.layer_features import LayerFeatures
 from ogr_tiller.poco.tileset_manifest import TilesetManifest
-from ogr_tiller.utils.fast_api_utils import abort_after
-from ogr_tiller.utils.ogr_utils import get_data_location, get_tileset_manifest
-from ogr_tiller.utils.proj_utils import get_bbox_for_crs
+from ogr_tiller.utils.budget_utils import encode_within_budget
+from ogr_tiller.utils.dataset_pool import get_dataset_pool
+from ogr_tiller.utils.fast_api_utils import check_deadline
+from ogr_tiller.utils.ogr_utils import get_tileset_manifest
+from ogr_tiller.utils.proj_utils import get_bbox_for_crs, get_bboxes_for_crs
 import morecantile
+import numpy as np
+import shapely
 from shapely.geometry import box, shape
 import fiona
-from shapely.ops import clip_by_rect, polylabel
 import os
 import traceback
 import warnings
@@ -20,22 +25,75 @@ from rich.progress import Progress, SpinnerColumn, TextColumn
 
 tms = morecantile.tms.get("WebMercatorQuad")
 
+GZIP_MAGIC = b'\x1f\x8b'
 
-def check_has_features_layers(layer_features: Tuple[str, List[Any]]):
+
+def compress_tile(tile_data: bytes) -> bytes:
+    # tiles are stored and cached gzip compressed, a fixed mtime keeps the bytes reproducible
+    return gzip.compress(tile_data, compresslevel=6, mtime=0)
+
+
+def is_compressed_tile(tile_data: bytes) -> bool:
+    # caches written by older versions hold uncompressed tiles
+    return tile_data[:2] == GZIP_MAGIC
+
+
+def decompress_tile(tile_data: bytes) -> bytes:
+    if is_compressed_tile(tile_data):
+        return gzip.decompress(tile_data)
+    return tile_data
+
+
+def check_has_features_layers(layer_features: List[LayerFeatures]):
     result = False
-    for layer_name, features in layer_features:
-        if len(features) > 0:
+    for layer in layer_features:
+        if len(layer) > 0:
             result = True
             break
     return result
 
 
+def index_layer_features(layer_features: List[LayerFeatures]):
+    # [(layer, bounds, candidate indices)] for the cache builder,
+    # bounds are computed once so every quadtree node only narrows down the parent candidates
+    result = []
+    for layer in layer_features:
+        bounds = shapely.bounds(layer.geometries).reshape(-1, 4)
+        result.append((layer, bounds, np.arange(len(layer))))
+    return result
+
+
+def check_has_candidates(layer_candidates):
+    for layer, bounds, indices in layer_candidates:
+        if len(indices) > 0:
+            return True
+    return False
+
+
+def world_clip_bbox(clip_bbox):
+    # keep the buffer from wrapping around the antimeridian
+    world = 20037508.342789244
+    return (max(clip_bbox[0], -world), clip_bbox[1], min(clip_bbox[2], world), clip_bbox[3])
+
+
+def native_tile_bounds(srid, bbox, clip_bbox, tolerance: float):
+    # tile math happens in web mercator, the features are in the dataset crs
+    if srid == 'EPSG:3857':
+        return bbox, clip_bbox, tolerance
+    native_bbox, native_clip_bbox = [
+        tuple(bounds) for bounds in
+        get_bboxes_for_crs("EPSG:3857", srid, [bbox, world_clip_bbox(clip_bbox)]).tolist()
+    ]
+    scale = abs(native_bbox[2] - native_bbox[0]) / abs(bbox[2] - bbox[0])
+    return native_bbox, native_clip_bbox, tolerance * scale
+
+
 def get_tile_descendant_tiles(
             tileset: str,
-            parent_layer_features: Tuple[str, List[Any]], 
+            parent_layer_candidates, 
             x: int, y: int, z: int, 
             manifest: TilesetManifest, srid: int, 
-            min_zoom: int, max_zoom: int, result, 
+            min_zoom: int, max_zoom: int, writer, 
             progress: Progress, progress_task_id):
         if z > max_zoom:
             return
@@ -52,20 +110,20 @@ def get_tile_descendant_tiles(
 
             # buffer to vertor tile
             clip_bbox = buffered_bbox(bbox_shape, unit_distance, manifest.tile_buffer)
-            clip_bbox_shape = shape(box(*clip_bbox))
             tolerance = unit_distance * manifest.simplify_tolerance
-            layer_features = filter_features(parent_layer_features, clip_bbox_shape)
-            if not check_has_features_layers(layer_features):
+            bbox, clip_bbox, tolerance = native_tile_bounds(srid, bbox, clip_bbox, tolerance)
+            layer_candidates = filter_features(parent_layer_candidates, clip_bbox)
+            if not check_has_candidates(layer_candidates):
                 return
 
 
             new_z = z + 1
             new_x = x * 2
             new_y = y * 2
-            get_tile_descendant_tiles(tileset, layer_features, new_x, new_y, new_z, manifest, srid, min_zoom, max_zoom, result, progress, progress_task_id)
-            get_tile_descendant_tiles(tileset, layer_features, new_x + 1, new_y, new_z, manifest, srid, min_zoom, max_zoom, result, progress, progress_task_id)
-            get_tile_descendant_tiles(tileset, layer_features, new_x, new_y + 1, new_z, manifest, srid, min_zoom, max_zoom, result, progress, progress_task_id)
-            get_tile_descendant_tiles(tileset, layer_features, new_x + 1, new_y + 1, new_z, manifest, srid, min_zoom, max_zoom, result, progress, progress_task_id)
+            get_tile_descendant_tiles(tileset, layer_candidates, new_x, new_y, new_z, manifest, srid, min_zoom, max_zoom, writer, progress, progress_task_id)
+            get_tile_descendant_tiles(tileset, layer_candidates, new_x + 1, new_y, new_z, manifest, srid, min_zoom, max_zoom, writer, progress, progress_task_id)
+            get_tile_descendant_tiles(tileset, layer_candidates, new_x, new_y + 1, new_z, manifest, srid, min_zoom, max_zoom, writer, progress, progress_task_id)
+            get_tile_descendant_tiles(tileset, layer_candidates, new_x + 1, new_y + 1, new_z, manifest, srid, min_zoom, max_zoom, writer, progress, progress_task_id)
 
 
             if z < min_zoom:
@@ -73,27 +131,87 @@ def get_tile_descendant_tiles(
             
             # print('\t processing', tileset, new_x, new_y, new_z)
 
+            # clipping only happens for the tiles which are emitted
+            layer_features = [layer.take(indices) for layer, bounds, indices in layer_candidates]
             layer_features = process_features(layer_features, clip_bbox, tolerance)
             if not check_has_features_layers(layer_features):
                 return
             
-            if srid != 'EPSG:3857':
-                bbox = get_bbox_for_crs("EPSG:3857", srid, bbox)
-            tile_data = tile_utils.encode_tile(layer_features, bbox, manifest.extent)
-            result.append((x, y, z, tile_data))
+            tile_data = compress_tile(encode_within_budget(
+                layer_features, manifest, bbox, lambda layers: tile_utils.encode_tile(layers, bbox, manifest.extent)))
+            writer.add(x, y, z, tile_data)
 
-            progress.update(progress_task_id, advance=1)
+            if progress is not None:
+                progress.update(progress_task_id, advance=1)
                 
         except Exception as e:
+            writer.errors += 1
             print('error processing ', tileset, x, y, z)
             print(e)
             traceback.print_exc()
 
 
 
-@abort_after()
+def is_valid_tile(x: int, y: int, z: int) -> bool:
+    return 0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_intersects_bounds(mercator_bounds, x: int, y: int, z: int, manifest: TilesetManifest) -> bool:
+    # bounds are padded by the tile buffer, features just outside the data bounds still reach edge tiles
+    if mercator_bounds is None:
+        return False
+    # plain arithmetic, the tile matrix set only defines zooms up to 24
+    world = 20037508.342789244
+    size = 2 * world / 2 ** z
+    left = -world + x * size
+    top = world - y * size
+    pad = size * manifest.tile_buffer / manifest.extent
+    minx, miny, maxx, maxy = mercator_bounds
+    return (left - pad <= maxx and left + size + pad >= minx and
+            top - size - pad <= maxy and top + pad >= miny)
+
+
+def decode_layer_features(tile_data: bytes) -> List[LayerFeatures]:
+    # tile coordinates with y up, as produced by encode_tile
+    result = []
+    for layer_name, layer in mapbox_vector_tile.decode(tile_data).items():
+        features = layer['features']
+        geometries = np.empty(len(features), dtype=object)
+        geometries[:] = [shape(feat['geometry']) for feat in features]
+        fields = []
+        for feat in features:
+            fields.extend(field for field in feat['properties'] if field not in fields)
+        properties = {}
+        for field in fields:
+            values = np.empty(len(features), dtype=object)
+            values[:] = [feat['properties'].get(field) for feat in features]
+            properties[field] = values
+        result.append(LayerFeatures(layer_name, geometries, properties))
+    return result
+
+
+def overzoom_tile(tile_data: bytes, x: int, y: int, z: int, parent_z: int, extent: int, tile_buffer: int):
+    # cuts the z/x/y tile out of its ancestor at parent_z and scales it up, no source data is read
+    scale = 2 ** (z - parent_z)
+    size = extent / scale
+    dx = x - (x >> (z - parent_z)) * scale
+    dy = y - (y >> (z - parent_z)) * scale
+    minx = dx * size
+    maxy = extent - dy * size
+    bbox = (minx, maxy - size, minx + size, maxy)
+    pad = tile_buffer / scale
+    clip_bbox = (bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad)
+
+    layer_features = decode_layer_features(decompress_tile(tile_data))
+    check_deadline()
+    layer_features = process_features(layer_features, clip_bbox, 0)
+    if not check_has_features_layers(layer_features):
+        return None
+    check_deadline()
+    return compress_tile(tile_utils.encode_tile(layer_features, bbox, extent))
+
+
 def get_tile(tileset: str, x: int, y: int, z: int, extent: int):
-    ds_path = os.path.join(get_data_location(), f'{tileset}.gpkg')
     bbox_bounds = tms.xy_bounds(morecantile.Tile(x, y, z))
     bbox = (bbox_bounds.left, bbox_bounds.bottom,
             bbox_bounds.right, bbox_bounds.top)
@@ -107,17 +225,19 @@ def get_tile(tileset: str, x: int, y: int, z: int, extent: int):
     clip_bbox = buffered_bbox(bbox_shape, unit_distance, manifest.tile_buffer)
     tolerance = unit_distance * manifest.simplify_tolerance
 
-    layer_features, srid = get_features(ds_path, clip_bbox)
+    layer_features, srid = get_features(tileset, clip_bbox, z)
     if len(layer_features) == 0:
         return None
+    check_deadline()
+    bbox, clip_bbox, tolerance = native_tile_bounds(srid, bbox, clip_bbox, tolerance)
     layer_features = process_features(layer_features, clip_bbox, tolerance)
     if not check_has_features_layers(layer_features):
         return  None
+    check_deadline()
     
-    if srid != 'EPSG:3857':
-        bbox = get_bbox_for_crs("EPSG:3857", srid, bbox)
-    tile_data = tile_utils.encode_tile(layer_features, bbox, extent)
-    return tile_data
+    tile_data = encode_within_budget(
+        layer_features, manifest, bbox, lambda layers: tile_utils.encode_tile(layers, bbox, extent))
+    return compress_tile(tile_data)
     
 
 def buffered_bbox(bbox_shape, unit_distance: float, buffer: int):
@@ -138,111 +258,160 @@ def make_valid_polygon(polygon):
         return polygon.buffer(0)
     return polygon
 
-def get_all_features(ds_path: str):
-    layers = fiona.listlayers(ds_path)
+def to_layer_features(layer_name: str, layer, features, layer_names: List[str]) -> List[LayerFeatures]:
+    # reads fiona features into columns
+    fields = list(layer.schema['properties'].keys())
+    geometries = []
+    columns = [[] for field in fields]
+    for feat in features:
+        if feat.geometry is None:
+            continue
+        geometries.append(shape(feat.geometry))
+        for column, value in zip(columns, feat.properties.values()):
+            column.append(value)
+
+    geometries_array = np.empty(len(geometries), dtype=object)
+    geometries_array[:] = geometries
+    properties = {}
+    for field, column in zip(fields, columns):
+        values = np.empty(len(column), dtype=object)
+        values[:] = column
+        properties[field] = values
+
+    return with_label_layer(LayerFeatures(layer_name, geometries_array, properties), layer_names)
+
+def with_label_layer(layer: LayerFeatures, layer_names: List[str]) -> List[LayerFeatures]:
+    # polygon layers get an extra label point layer, prepared datasets have it precomputed
+    result = [layer]
+    if f'{layer.name}_label' in layer_names:
+        return result
+    polygons = np.isin(shapely.get_type_id(layer.geometries), [3, 6])
+    if polygons.any():
+        label_layer = layer.take(polygons)
+        label_layer.name = f'{layer.name}_label'
+        label_layer.geometries = shapely.point_on_surface(label_layer.geometries)
+        result.append(label_layer)
+    return result
+
+def get_read_options(manifest: TilesetManifest, layer_name: str, zoom: int):
+    # (property allowlist, where) of a layer, both are handed to the OGR read
+    if manifest is None:
+        return None, None
+    layer_manifest = manifest.get_layer_manifest(layer_name)
+    where = layer_manifest.get_where(zoom) if zoom is not None else None
+    return layer_manifest.properties, where
+
+def list_dataset_layers(ds_path: str) -> List[str]:
+    if arrow_utils.use_arrow_reader():
+        return arrow_utils.list_layer_names(ds_path)
+    return fiona.listlayers(ds_path)
+
+def get_layer_features(ds_path: str, layer_name: str, layer_names: List[str], properties: List[str] = None, where: str = None):
+    # (srid, [layer and its label layer]) of every feature of one layer matching the where
+    if arrow_utils.use_arrow_reader():
+        srid, layer = arrow_utils.read_layer_features(ds_path, layer_name, columns=properties, where=where)
+        return srid, with_label_layer(layer, layer_names)
+
+    with fiona.open(ds_path, 'r', layer=layer_name, include_fields=properties) as layer:
+        features = layer.filter(where=where) if where is not None else layer
+        return layer.crs, to_layer_features(layer_name, layer, features, layer_names)
+
+def layer_clip_bbox(srid, clip_bbox):
+    if srid != 'EPSG:3857':
+        return get_bbox_for_crs("EPSG:3857", srid, world_clip_bbox(clip_bbox))
+    return clip_bbox
+
+def get_features_arrow(tileset: str, clip_bbox, zoom: int = None):
+    # one batched read per layer, the dataset is opened by pyogrio for every read
     result = []
 
     srid = None
 
-    for layer_name in layers:
-        processed_features = []
-        label_features = []
-        with fiona.open(ds_path, 'r', layer=layer_name) as layer:
-            srid = layer.crs
-            for feat in layer:
-                geom = shape(feat.geometry)
-                processed_features.append({
-                    "geometry": geom,
-                    "properties": feat.properties
-                })
-
-                if geom.geom_type in ['Polygon', '3D Polygon', 'MultiPolygon', '3D MultiPolygon']:
-                    label_point = geom.representative_point()
-                    label_features.append({
-                        "geometry": label_point,
-                        "properties": feat['properties']
-                    })   
-        result.append((layer_name, processed_features))
-        if len(label_features) > 0:
-            result.append((f'{layer_name}_label', label_features))
+    manifest: TilesetManifest = get_tileset_manifest()[tileset]
+    ds_path, layer_names = get_dataset_pool(tileset, zoom).source()
+    mtime = os.path.getmtime(ds_path)
+    for layer_name in layer_names:
+        check_deadline()
+        srid = arrow_utils.get_layer_crs(ds_path, mtime, layer_name)
+        properties, where = get_read_options(manifest, layer_name, zoom)
+        srid, layer = arrow_utils.read_layer_features(
+            ds_path, layer_name, layer_clip_bbox(srid, clip_bbox), columns=properties, where=where)
+        result.extend(with_label_layer(layer, layer_names))
     return result, srid
 
-def get_features(ds_path: str, clip_bbox):
-    layers = fiona.listlayers(ds_path)
+def get_features(tileset: str, clip_bbox, zoom: int = None):
+    # with a zoom, pre-simplified level of detail copies are read when there are any and
+    # the filters of the zoom apply. the pooled handles only read the allowed properties.
+    if arrow_utils.use_arrow_reader():
+        return get_features_arrow(tileset, clip_bbox, zoom)
+
     result = []
 
     srid = None
 
-    for layer_name in layers:
-        processed_features = []
-        label_features = []
-        with fiona.open(ds_path, 'r', layer=layer_name) as layer:
+    manifest: TilesetManifest = get_tileset_manifest()[tileset]
+    with get_dataset_pool(tileset, zoom).layers() as layers:
+        layer_names = [layer_name for layer_name, layer in layers]
+        for layer_name, layer in layers:
+            check_deadline()
             srid = layer.crs
-            if srid != 'EPSG:3857':
-                clip_bbox = get_bbox_for_crs("EPSG:3857", srid, clip_bbox)
-
-            features = layer.filter(bbox=clip_bbox)
-            for feat in features:
-                geom = shape(feat.geometry)
-                processed_features.append({
-                    "geometry": geom,
-                    "properties": feat.properties
-                })
-
-                if geom.geom_type in ['Polygon', '3D Polygon', 'MultiPolygon', '3D MultiPolygon']:
-                    label_point = geom.representative_point()
-                    label_features.append({
-                        "geometry": label_point,
-                        "properties": feat['properties']
-                    })   
-        result.append((layer_name, processed_features))
-        if len(label_features) > 0:
-            result.append((f'{layer_name}_label', label_features))
+            properties, where = get_read_options(manifest, layer_name, zoom)
+            features = layer.filter(bbox=layer_clip_bbox(srid, clip_bbox), where=where)
+            result.extend(to_layer_features(layer_name, layer, features, layer_names))
     return result, srid
 
-def filter_features(layer_features: Tuple[str, List[Any]], clip_bbox_shape):
+def filter_features(layer_candidates, clip_bbox):
+    minx, miny, maxx, maxy = clip_bbox
+    clip_bbox_shape = box(*clip_bbox)
     result = []
-    for layer_name, features in layer_features:
-        filtered_features = []
-        for feat in features:
-            geom = feat['geometry']
-            processed_geom = clip_by_rect(
-                geom,
-                *clip_bbox_shape.bounds
-            )
-            if not processed_geom.is_empty:
-                filtered_features.append(feat)
-        result.append((layer_name, filtered_features))
+    for layer, bounds, indices in layer_candidates:
+        # cheap bbox test against the parent candidates, exact test only on the survivors
+        candidate_bounds = bounds[indices]
+        indices = indices[
+            (candidate_bounds[:, 0] <= maxx) & (candidate_bounds[:, 2] >= minx) &
+            (candidate_bounds[:, 1] <= maxy) & (candidate_bounds[:, 3] >= miny)
+        ]
+        if len(indices) > 0:
+            indices = indices[shapely.intersects(layer.geometries[indices], clip_bbox_shape)]
+        result.append((layer, bounds, indices))
     return result
 
-def process_features(layer_features: Tuple[str, List[Any]], clip_bbox, tolerance: float):
+def process_features(layer_features: List[LayerFeatures], clip_bbox, tolerance: float):
     result = []
-    for layer_name, features in layer_features:
-        processed_features = []
-        for feat in features:
-            geom = feat['geometry']
-            processed_geom = clip_by_rect(
-                geom,
-                *clip_bbox
-            )
-            processed_geom = processed_geom.simplify(tolerance, False)
-            processed_features.append({
-                "geometry": processed_geom,
-                "properties": feat['properties']
-            })
-        result.append((layer_name, processed_features))
+    for layer in layer_features:
+        # whole layer at once, empty results are skipped by the encoder anyway
+        geometries = shapely.clip_by_rect(layer.geometries, *clip_bbox)
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=False)
+        processed_layer = LayerFeatures(layer.name, geometries, layer.properties)
+        result.append(processed_layer.take(~shapely.is_empty(geometries)))
     return result
 
 
 
-def encode_tile(layer_features: Tuple[str, List[Any]], bbox, extent: int):
-    result = b''
-    for layer_name, features in layer_features:
-        tile = mapbox_vector_tile.encode([
-            {
-                "name": layer_name,
-                "features": features
-            }
-        ], default_options={'quantize_bounds': bbox, 'extents':extent})
-        result += tile
-    return result
+def quantize_geometries(geometries: np.ndarray, bbox, extent: int) -> np.ndarray:
+    # same arithmetic and rounding as the quantize_bounds option of mapbox_vector_tile,
+    # applied to all coordinates of the layer with numpy instead of vertex by vertex
+    minx, miny, maxx, maxy = bbox
+    xfac = extent / (maxx - minx)
+    yfac = extent / (maxy - miny)
+
+    def to_tile_space(coords):
+        result = np.empty_like(coords)
+        result[:, 0] = np.round(xfac * (coords[:, 0] - minx))
+        result[:, 1] = np.round(yfac * (coords[:, 1] - miny))
+        return result
+
+    return shapely.transform(geometries, to_tile_space)
+
+
+def encode_tile(layer_features: List[LayerFeatures], bbox, extent: int):
+    # all layers are serialized in one call, the bytes match encoding the layers one by one
+    layers = []
+    for layer in layer_features:
+        quantized_layer = LayerFeatures(
+            layer.name, quantize_geometries(layer.geometries, bbox, extent), layer.properties)
+        layers.append({
+            "name": layer.name,
+            "features": quantized_layer.iter_features()
+        })
+    return mapbox_vector_tile.encode(layers, default_options={'extents': extent})
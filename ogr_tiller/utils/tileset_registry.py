@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+from typing import Any, List, Optional, Tuple
+import morecantile
+from ogr_tiller.utils.fast_api_utils import content_etag
+from ogr_tiller.utils.memory_cache import get_memory_cache
+from ogr_tiller.utils.ogr_utils import get_data_location, get_tileset_manifest, read_tileset_metadata
+from ogr_tiller.utils.stylesheet_utils import get_starter_style
+
+tms = morecantile.tms.get("WebMercatorQuad")
+
+# tileset metadata computed once and refreshed when the source file changes
+registry_port = None
+registry_lock = threading.Lock()
+tileset_registry = {}
+cached_starter_style = None
+
+
+class TilesetInfo:
+    def __init__(self,
+                 tileset: str,
+                 mtime: float,
+                 tilejson: Any,
+                 layer_geometry_types: List[Tuple[str, str]]):
+        self.tileset = tileset
+        self.mtime = mtime
+        self.tilejson = tilejson
+        self.layer_geometry_types = layer_geometry_types
+        self.mercator_bounds = get_mercator_bounds(tilejson['bounds'])
+        self.tilejson_bytes = json.dumps(tilejson).encode()
+        self.etag = content_etag(self.tilejson_bytes)
+
+
+class StarterStyle:
+    def __init__(self, key: Tuple[str, ...], style_json: Any):
+        # key holds the etags of the tilesets the style was built from
+        self.key = key
+        self.style_json = style_json
+        self.content = json.dumps(style_json).encode()
+        self.etag = content_etag(self.content)
+
+
+def get_mercator_bounds(bounds) -> Optional[Tuple[float, float, float, float]]:
+    # tilejson bounds are lng/lat, tile checks happen in web mercator
+    if bounds is None:
+        return None
+    left, bottom = tms.xy(bounds[0], bounds[1], truncate=True)
+    right, top = tms.xy(bounds[2], bounds[3], truncate=True)
+    return (left, bottom, right, top)
+
+
+def get_source_mtime(tileset: str) -> float:
+    return os.path.getmtime(os.path.join(get_data_location(), f'{tileset}.gpkg'))
+
+
+def load_tileset_info(tileset: str) -> TilesetInfo:
+    mtime = get_source_mtime(tileset)
+    manifest = get_tileset_manifest()[tileset]
+    tilejson, layer_geometry_types = read_tileset_metadata(tileset, registry_port, manifest)
+    return TilesetInfo(tileset, mtime, tilejson, layer_geometry_types)
+
+
+def setup_tileset_registry(port: str, tilesets: List[str]):
+    global registry_port, tileset_registry, cached_starter_style
+    with registry_lock:
+        registry_port = port
+        tileset_registry = {tileset: load_tileset_info(tileset) for tileset in tilesets}
+        cached_starter_style = None
+
+
+def get_tileset_info(tileset: str) -> TilesetInfo:
+    info = tileset_registry[tileset]
+    if get_source_mtime(tileset) == info.mtime:
+        return info
+    with registry_lock:
+        info = tileset_registry[tileset]
+        if get_source_mtime(tileset) != info.mtime:
+            info = load_tileset_info(tileset)
+            tileset_registry[tileset] = info
+            # tiles of the previous version of the file are not served from memory anymore
+            memory_cache = get_memory_cache()
+            if memory_cache is not None:
+                memory_cache.clear(tileset)
+    return info
+
+
+def get_starter_style_info(tilesets: List[str]) -> StarterStyle:
+    global cached_starter_style
+    infos = [get_tileset_info(tileset) for tileset in tilesets]
+    key = tuple(info.etag for info in infos)
+    starter_style = cached_starter_style
+    if starter_style is None or starter_style.key != key:
+        layer_geometry_types = [
+            (info.tileset, layer_name, geometry_type)
+            for info in infos
+            for layer_name, geometry_type in info.layer_geometry_types
+        ]
+        starter_style = StarterStyle(key, get_starter_style(registry_port, tilesets, layer_geometry_types))
+        cached_starter_style = starter_style
+    return starter_style
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from ogr_tiller.utils.fast_api_utils import TimeOutException, check_deadline, set_deadline
+
+
+class PoolSaturatedException(Exception):
+    """Too many tiles are already waiting for a worker"""
+
+
+def run_with_deadline(deadline: float, func: Callable, *args):
+    # runs on the worker, module level so it can be pickled for process pools
+    set_deadline(deadline)
+    try:
+        check_deadline()
+        return func(*args)
+    finally:
+        set_deadline(None)
+
+
+class TileWorkerPool:
+    """Bounded thread or process pool for tile generation, off the asyncio event loop"""
+
+    def __init__(self,
+                 executor_type: str,
+                 max_workers: int,
+                 max_queue: int,
+                 timeout: int,
+                 initializer: Callable = None,
+                 initargs: tuple = ()):
+        self.timeout = timeout
+        self.executor: Executor = None
+        if executor_type == 'process':
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=initializer, initargs=initargs)
+        elif executor_type == 'thread':
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix='tile_worker')
+        else:
+            raise ValueError(f'unknown tile executor {executor_type}')
+        # running plus queued tiles; a slot is only released once the work really finishes
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    async def run(self, func: Callable, *args) -> Any:
+        if not self.slots.acquire(blocking=False):
+            raise PoolSaturatedException('tile worker pool is saturated')
+
+        deadline = time.time() + self.timeout
+        try:
+            future = self.executor.submit(run_with_deadline, deadline, func, *args)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # queued work is dropped, running work stops at its next deadline check
+            future.cancel()
+            raise TimeOutException(f"Function execution took longer than {self.timeout}s and was terminated")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,52 @@
+import fiona
+import shapely
+from shapely.geometry import mapping
+from ogr_tiller import cache_builder
+from ogr_tiller.poco.job_param import JobParam
+from ogr_tiller.utils import tile_utils
+from ogr_tiller.utils.ogr_utils import setup_ogr_cache
+from ogr_tiller.utils.sqlite_utils import close_connection_managers, get_built_subtrees, setup_mbtile_cache
+
+
+def setup_tileset(tmp_path):
+    data_folder = tmp_path / 'data'
+    cache_folder = tmp_path / 'cache'
+    data_folder.mkdir()
+    cache_folder.mkdir()
+    schema = {'geometry': 'Point', 'properties': {'name': 'str'}}
+    with fiona.open(str(data_folder / 'towns.gpkg'), 'w', driver='GPKG', schema=schema, crs='EPSG:3857', layer='towns') as layer:
+        layer.writerecords(
+            fiona.Feature.from_dict({'geometry': mapping(shapely.Point(x * 100000, x * 100000)), 'properties': {'name': str(x)}})
+            for x in range(10)
+        )
+    (data_folder / 'manifest.yml').write_text('config:\n  defaults:\n    maxzoom: 2\n')
+    setup_ogr_cache(str(data_folder))
+    setup_mbtile_cache('towns', str(cache_folder), {'minzoom': 0, 'maxzoom': 2})
+    close_connection_managers()
+    # loaded features are kept per process
+    cache_builder.loaded_tileset = None
+    return JobParam('build_cache', str(data_folder), str(cache_folder), None, '8080', False, 3)
+
+
+def test_subtree_is_checkpointed(tmp_path):
+    job_param = setup_tileset(tmp_path)
+
+    assert cache_builder.build_subtree(job_param, 'towns', 0, 0, 0, 0, 2) > 0
+
+    assert get_built_subtrees('towns') == {(0, 0, 0, 2)}
+
+
+def test_subtree_with_failed_tiles_is_not_checkpointed(tmp_path, monkeypatch):
+    job_param = setup_tileset(tmp_path)
+    encode_tile = tile_utils.encode_tile
+
+    def fail_zoom_1(layers, bbox, extent):
+        if bbox[2] - bbox[0] < 30000000:
+            raise ValueError('encoding failed')
+        return encode_tile(layers, bbox, extent)
+
+    monkeypatch.setattr(tile_utils, 'encode_tile', fail_zoom_1)
+
+    cache_builder.build_subtree(job_param, 'towns', 0, 0, 0, 0, 2)
+
+    assert get_built_subtrees('towns') == set()
@@ -0,0 +1,18 @@
+from ogr_tiller.utils.directory_utils import cleanup_orphan_tile_folders, get_tile_folder, write_static_tilejson
+from ogr_tiller.utils.prepare_utils import get_prepared_folder
+
+
+def test_tile_folder_does_not_clash_with_prepared_folder(tmp_path):
+    cache_folder = str(tmp_path)
+    prepared_folder = tmp_path / 'prepared'
+    prepared_folder.mkdir()
+    (prepared_folder / 'towns.gpkg').write_bytes(b'')
+    write_static_tilejson(get_tile_folder(cache_folder, 'prepared'), {'tiles': []})
+    write_static_tilejson(get_tile_folder(cache_folder, 'gone'), {'tiles': []})
+
+    assert get_tile_folder(cache_folder, 'prepared') != get_prepared_folder(cache_folder)
+
+    cleanup_orphan_tile_folders(cache_folder, ['towns'])
+
+    assert (prepared_folder / 'towns.gpkg').exists()
+    assert not (tmp_path / 'tiles' / 'gone').exists()
@@ -0,0 +1,60 @@
+import fiona
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+from ogr_tiller.poco.layer_features import LayerFeatures
+from ogr_tiller.utils.prepare_utils import get_prepare_options, is_prepared_fresh, prepare_tileset, read_layer
+from ogr_tiller.utils.tile_utils import encode_tile
+
+# a square with a spike, make_valid returns it as a polygon and a line in a collection
+SPIKED_POLYGON = 'POLYGON ((0 0, 1000 0, 1000 1000, 1500 1500, 1000 1000, 0 1000, 0 0))'
+
+
+def write_source(ds_path, wkts):
+    schema = {'geometry': 'Polygon', 'properties': {'name': 'str'}}
+    with fiona.open(ds_path, 'w', driver='GPKG', schema=schema, crs='EPSG:3857', layer='parks') as layer:
+        layer.writerecords(
+            fiona.Feature.from_dict({'geometry': mapping(shapely.from_wkt(wkt)), 'properties': {'name': str(i)}})
+            for i, wkt in enumerate(wkts)
+        )
+
+
+def test_prepared_polygons_have_no_collections(tmp_path):
+    ds_path = str(tmp_path / 'parks.gpkg')
+    prepared_path = str(tmp_path / 'parks.prepared.gpkg')
+    write_source(ds_path, [SPIKED_POLYGON, 'POLYGON ((0 0, 10 0, 0 10, 10 10, 0 0))'])
+    assert shapely.get_type_id(shapely.make_valid(shapely.from_wkt(SPIKED_POLYGON))) == 7
+
+    prepare_tileset(ds_path, prepared_path)
+
+    _, _, geometries, properties = read_layer(prepared_path, 'parks')
+    assert [p['name'] for p in properties] == ['0', '1']
+    assert list(shapely.get_type_id(geometries)) == [3, 6]
+    assert shapely.is_valid(geometries).all()
+    assert shapely.area(geometries[0]) == 1000 * 1000
+
+    layer = LayerFeatures('parks', geometries, {'name': np.array([p['name'] for p in properties], dtype=object)})
+    assert len(encode_tile([layer], (0, 0, 2000, 2000), 4096)) > 0
+
+
+def test_empty_polygons_get_no_label_point(tmp_path):
+    ds_path = str(tmp_path / 'parks.gpkg')
+    prepared_path = str(tmp_path / 'parks.prepared.gpkg')
+    write_source(ds_path, ['POLYGON EMPTY', 'POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))'])
+
+    prepare_tileset(ds_path, prepared_path, use_polylabel=True)
+
+    _, _, labels, properties = read_layer(prepared_path, 'parks_label')
+    assert [p['name'] for p in properties] == ['1']
+    assert shapely.Point(5, 5).distance(labels[0]) < 1
+
+
+def test_prepared_copy_is_stale_with_other_settings(tmp_path):
+    ds_path = str(tmp_path / 'parks.gpkg')
+    prepared_path = str(tmp_path / 'parks.prepared.gpkg')
+    write_source(ds_path, ['POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))'])
+
+    prepare_tileset(ds_path, prepared_path, use_polylabel=False)
+
+    assert is_prepared_fresh(ds_path, prepared_path, get_prepare_options(False))
+    assert not is_prepared_fresh(ds_path, prepared_path, get_prepare_options(True))